@@ -0,0 +1,122 @@
+"""Synthetic timesheets, Toggl accounts and bank transactions of configurable size"""
+import random
+from datetime import date, timedelta
+
+
+SIZES = {
+    'week': 7,
+    'month': 31,
+    'quarter': 92,
+    'year': 365,
+    '3years': 3 * 365,
+}
+
+CLIENTS = [{'id': 1, 'name': 'Development'}, {'id': 2, 'name': 'Clients'}]
+PROJECTS = [
+    {'id': 11, 'cid': 1, 'name': 'Ingest'},
+    {'id': 12, 'cid': 1, 'name': 'Reporting'},
+    {'id': 21, 'cid': 2, 'name': 'Support'},
+]
+SPREADSHEET_ID = 'bench-timesheet'
+TRANSACTIONS_ID = 'bench-transactions'
+TIMESHEET_HEADERS = ['Date', 'Daily hours', 'Tasks', 'Project']
+TRANSACTION_HEADERS = ['id', 'date', 'amount', 'message', 'Supplier', 'Link', 'Status']
+
+
+class Transaction:
+    """Minimal bank transaction as consumed by GoogleTransactionSheets"""
+
+    def __init__(self, id, amount, meta):
+        self.id = id
+        self.amount = amount
+        self.meta = meta
+
+
+class Dataset:
+    def __init__(self, size, start=date(2020, 1, 6), synced_ratio=0.5, seed=1):
+        """
+        :param size: key of SIZES
+        :param synced_ratio: share of the sheet rows which already exist in Toggl
+        """
+        self.size = size
+        self.start = start
+        self.end = start + timedelta(days=SIZES[size] - 1)
+        self.random = random.Random(seed)
+        self.rows = self.build_rows()
+        synced = self.random.sample(range(len(self.rows)), int(len(self.rows) * synced_ratio))
+        self.toggl_entries = [self.toggl_entry(self.rows[i]) for i in sorted(synced)]
+
+    def build_rows(self):
+        rows = []
+        day = self.start
+        while day <= self.end:
+            if day.weekday() < 5:
+                project = self.random.choice(PROJECTS)
+                rows.append({
+                    'date': day,
+                    'minutes': self.random.randrange(60, 9 * 60, 15),
+                    'tasks': 'Task %s on %s' % (self.random.randrange(1000), project['name']),
+                    'project': project,
+                })
+            day += timedelta(days=1)
+        return rows
+
+    @staticmethod
+    def toggl_entry(row):
+        return {
+            'start': '%sT08:00:00+00:00' % row['date'].isoformat(),
+            'duration': row['minutes'] * 60,
+            'description': row['tasks'],
+            'pid': row['project']['id'],
+            'billable': False,
+        }
+
+    def timesheet_tabs(self):
+        """One daily timesheet tab per month, header in row 5 and a row for every day of the month"""
+        by_date = {row['date']: row for row in self.rows}
+        tabs = {}
+        month = self.start.replace(day=1)
+        while month <= self.end:
+            grid = [['Timesheet %s' % month.strftime('%B %Y')], [], [], [], list(TIMESHEET_HEADERS)]
+            day = month
+            while day.month == month.month:
+                row = by_date.get(day)
+                if row and self.start <= day <= self.end:
+                    grid.append([
+                        day.strftime('%d %b %Y'),
+                        '{0:02d}:{1:02d}'.format(*divmod(row['minutes'], 60)),
+                        row['tasks'],
+                        row['project']['name'],
+                    ])
+                else:
+                    grid.append([day.strftime('%d %b %Y'), '', '', ''])
+                day += timedelta(days=1)
+            tabs[month.strftime('%b %y')] = grid
+            month = (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+        return tabs
+
+    def transactions(self, booked_ratio=0.0):
+        # same amounts on every call, only the booking status differs, reproducibly for the dataset seed
+        amounts = random.Random(len(self.rows))
+        bookings = random.Random(self.random.getrandbits(32))
+        transactions = []
+        for i in range(len(self.rows) * 3):
+            day = self.start + timedelta(days=i % SIZES[self.size])
+            amount = '%.2f' % amounts.uniform(-500, 500)
+            booked = bookings.random() < booked_ratio
+            transactions.append(Transaction(i + 1, amount, {
+                'id': i + 1,
+                'date': day.isoformat(),
+                'amount': amount,
+                'message': 'Payment %s' % (i + 1),
+                'supplier': 'Supplier %s' % (i % 17) if amount.startswith('-') else '',
+                'link': '',
+                'status': 'booked' if booked else 'pending',
+            }))
+        return transactions
+
+    def spreadsheets(self):
+        return {
+            SPREADSHEET_ID: self.timesheet_tabs(),
+            TRANSACTIONS_ID: {'Transactions': [list(TRANSACTION_HEADERS)]},
+        }
@@ -0,0 +1,180 @@
+"""Stand-in for the parts of the Google Sheets v4 API used by gspread"""
+import re
+import threading
+from datetime import datetime, timezone
+
+import requests
+
+from benchmarks.server import FakeServer
+
+
+SHEETS_BASE = 'https://sheets.googleapis.com'
+DRIVE_BASE = 'https://www.googleapis.com'
+CELL_RE = re.compile(r'^([A-Za-z]*)(\d*)$')
+
+
+def column_index(letters):
+    index = 0
+    for char in letters.upper():
+        index = index * 26 + ord(char) - ord('A') + 1
+    return index
+
+
+def parse_range(a1):
+    """Split 'Title!A1:C5' into title and 0 based (first_row, first_col, last_row, last_col), None is unbounded"""
+    if '!' in a1:
+        title, cells = a1.rsplit('!', 1)
+    else:
+        title, cells = a1, ''
+    if title.startswith("'") and title.endswith("'"):
+        title = title[1:-1].replace("''", "'")
+    if not cells:
+        return title, (0, 0, None, None)
+    first, _, last = cells.partition(':')
+    first_col, first_row = CELL_RE.match(first).groups()
+    last_col, last_row = CELL_RE.match(last or first).groups()
+    return title, (
+        int(first_row) - 1 if first_row else 0,
+        column_index(first_col) - 1 if first_col else 0,
+        int(last_row) - 1 if last_row else None,
+        column_index(last_col) - 1 if last_col else None,
+    )
+
+
+class FakeSheetsServer(FakeServer):
+    name = 'sheets'
+
+    def __init__(self, spreadsheets, **kwargs):
+        """
+        :param spreadsheets: {spreadsheet_id: {tab title: [[cell, ...], ...]}}, cells are strings
+        """
+        super().__init__(**kwargs)
+        self.spreadsheets = spreadsheets
+        self.grid_lock = threading.Lock()
+        # Drive file version of every spreadsheet, raised by each change
+        self.versions = {spreadsheet_id: 1 for spreadsheet_id in spreadsheets}
+        self.modified = {spreadsheet_id: '2022-01-01T00:00:00.000Z' for spreadsheet_id in spreadsheets}
+
+    def call_label(self, method, path):
+        # keep the spreadsheet id but fold the A1 ranges of the values API
+        label = super().call_label(method, path)
+        return re.sub(r'/values/[^:]+$', '/values/{range}', label)
+
+    def metadata(self, spreadsheet_id):
+        tabs = self.spreadsheets[spreadsheet_id]
+        return {
+            'spreadsheetId': spreadsheet_id,
+            'properties': {'title': spreadsheet_id},
+            'sheets': [
+                {'properties': {
+                    'sheetId': i,
+                    'title': title,
+                    'index': i,
+                    'sheetType': 'GRID',
+                    'gridProperties': {'rowCount': max(1000, len(rows)), 'columnCount': 26},
+                }}
+                for i, (title, rows) in enumerate(tabs.items())
+            ],
+        }
+
+    def read(self, spreadsheet_id, a1, major_dimension='ROWS'):
+        title, (first_row, first_col, last_row, last_col) = parse_range(a1)
+        with self.grid_lock:
+            rows = self.spreadsheets[spreadsheet_id][title]
+            selected = rows[first_row:None if last_row is None else last_row + 1]
+            values = [list(row[first_col:None if last_col is None else last_col + 1]) for row in selected]
+        if major_dimension == 'COLUMNS':
+            width = max((len(row) for row in values), default=0)
+            values = [[row[c] if c < len(row) else '' for row in values] for c in range(width)]
+        # the API omits trailing empty cells and rows
+        values = [self.trim(row) for row in values]
+        while values and not values[-1]:
+            values.pop()
+        result = {'range': a1, 'majorDimension': major_dimension}
+        if values:
+            result['values'] = values
+        return result
+
+    @staticmethod
+    def trim(row):
+        row = list(row)
+        while row and row[-1] in ('', None):
+            row.pop()
+        return row
+
+    def write(self, spreadsheet_id, a1, values):
+        title, (first_row, first_col, _, _) = parse_range(a1)
+        with self.grid_lock:
+            rows = self.spreadsheets[spreadsheet_id][title]
+            for r, new_row in enumerate(values):
+                while len(rows) <= first_row + r:
+                    rows.append([])
+                row = rows[first_row + r]
+                while len(row) < first_col + len(new_row):
+                    row.append('')
+                for c, value in enumerate(new_row):
+                    row[first_col + c] = '' if value is None else str(value)
+            self.touch(spreadsheet_id)
+        return {
+            'spreadsheetId': spreadsheet_id,
+            'updatedRange': a1,
+            'updatedRows': len(values),
+            'updatedCells': sum(len(row) for row in values),
+        }
+
+    def touch(self, spreadsheet_id):
+        self.versions[spreadsheet_id] += 1
+        self.modified[spreadsheet_id] = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+
+    def drive_file(self, spreadsheet_id):
+        with self.grid_lock:
+            return {'version': str(self.versions[spreadsheet_id]), 'modifiedTime': self.modified[spreadsheet_id]}
+
+    def route(self, method, path, query, body):
+        drive = re.match(r'^/drive/v3/files/([^/]+)$', path)
+        if drive and drive.group(1) in self.spreadsheets and method == 'GET':
+            return 200, self.drive_file(drive.group(1))
+        match = re.match(r'^/v4/spreadsheets/([^/:]+)(.*)$', path)
+        if not match or match.group(1) not in self.spreadsheets:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        spreadsheet_id, rest = match.groups()
+        if rest == '' and method == 'GET':
+            return 200, self.metadata(spreadsheet_id)
+        if rest == ':batchUpdate' and method == 'POST':
+            # formatting requests are accepted and ignored, they still make a new version
+            with self.grid_lock:
+                self.touch(spreadsheet_id)
+            return 200, {'spreadsheetId': spreadsheet_id, 'replies': [{} for _ in body.get('requests', [])]}
+        if rest == '/values:batchUpdate' and method == 'POST':
+            responses = [self.write(spreadsheet_id, d['range'], d['values']) for d in body['data']]
+            return 200, {'spreadsheetId': spreadsheet_id, 'responses': responses}
+        if rest.startswith('/values/'):
+            a1 = rest[len('/values/'):]
+            if method == 'GET':
+                return 200, self.read(spreadsheet_id, a1, query.get('majorDimension', 'ROWS'))
+            if method == 'PUT':
+                return 200, self.write(spreadsheet_id, a1, body['values'])
+        return 404, {'error': {'code': 404, 'message': 'unknown endpoint %s' % path}}
+
+
+class RedirectAdapter(requests.adapters.HTTPAdapter):
+    """Send the requests of a session to the fake server instead of Google"""
+
+    def __init__(self, base_url, google_base=SHEETS_BASE):
+        super().__init__()
+        self.base_url = base_url
+        self.google_base = google_base
+
+    def send(self, request, **kwargs):
+        request.url = self.base_url + request.url[len(self.google_base):]
+        return super().send(request, **kwargs)
+
+
+def sheets_client(base_url):
+    """gspread client talking to the fake server, no credentials needed"""
+    import gspread
+
+    session = requests.Session()
+    session.mount(SHEETS_BASE, RedirectAdapter(base_url, SHEETS_BASE))
+    session.mount(DRIVE_BASE, RedirectAdapter(base_url, DRIVE_BASE))
+    return gspread.Client(auth=None, session=session)
@@ -0,0 +1,138 @@
+"""Stand-in for the parts of the Toggl v8 API used by TogglPy"""
+import csv
+import io
+import itertools
+import threading
+from datetime import datetime, timezone
+
+from benchmarks.server import FakeServer
+from lambdas.lib.toggl.TogglPy import Endpoints
+
+
+TOGGL_BASE = 'https://api.track.toggl.com'
+# the v8 time entries listing returns at most this many entries
+TIME_ENTRIES_CAP = 1000
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).astimezone(timezone.utc)
+
+
+class FakeTogglServer(FakeServer):
+    name = 'toggl'
+
+    def __init__(self, clients, projects, entries=(), **kwargs):
+        """
+        :param clients: [{'id': int, 'name': str}]
+        :param projects: [{'id': int, 'cid': int, 'name': str}]
+        :param entries: time entries as returned by Toggl, start as iso string
+        """
+        super().__init__(**kwargs)
+        self.clients = list(clients)
+        self.projects = list(projects)
+        self.entries = {}
+        # deleted entries, reported by the /me delta
+        self.tombstones = []
+        self.entries_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        for entry in entries:
+            self.add_entry(dict(entry))
+
+    def add_entry(self, entry):
+        with self.entries_lock:
+            entry.setdefault('id', next(self.ids))
+            entry.setdefault('at', datetime.now(timezone.utc).isoformat())
+            entry['start'] = parse_time(entry['start']).isoformat()
+            self.entries[entry['id']] = entry
+        return entry
+
+    def route(self, method, path, query, body):
+        if path == '/reports/api/v2/details.csv':
+            return 200, self.detailed_csv(query)
+        parts = path.strip('/').split('/')
+        if parts[:2] != ['api', 'v8']:
+            return 404, {'error': 'unknown endpoint %s' % path}
+        parts = parts[2:]
+        if parts == ['me']:
+            return 200, self.me(query)
+        if parts == ['clients'] and method == 'GET':
+            return 200, self.clients
+        if len(parts) == 3 and parts[0] == 'clients' and parts[2] == 'projects':
+            return 200, [p for p in self.projects if p['cid'] == int(parts[1])]
+        if len(parts) == 2 and parts[0] == 'projects':
+            return 200, {'data': next(p for p in self.projects if p['id'] == int(parts[1]))}
+        if parts == ['time_entries'] and method == 'GET':
+            return 200, self.list_entries(query)
+        if parts == ['time_entries'] and method == 'POST':
+            return 200, {'data': self.add_entry(body['time_entry'])}
+        if len(parts) == 2 and parts[0] == 'time_entries' and parts[1].isdigit():
+            entry_id = int(parts[1])
+            with self.entries_lock:
+                if entry_id not in self.entries:
+                    return 404, {'error': 'not found'}
+                if method == 'DELETE':
+                    deleted = self.entries.pop(entry_id)
+                    now = datetime.now(timezone.utc).isoformat()
+                    self.tombstones.append(dict(deleted, at=now, server_deleted_at=now))
+                    return 200, b''
+                if method == 'PUT':
+                    self.entries[entry_id].update(body['time_entry'])
+                    self.entries[entry_id]['at'] = datetime.now(timezone.utc).isoformat()
+                return 200, {'data': self.entries[entry_id]}
+        return 404, {'error': 'unknown endpoint %s' % path}
+
+    def list_entries(self, query):
+        start = parse_time(query['start_date'])
+        end = parse_time(query['end_date'])
+        with self.entries_lock:
+            entries = [e for e in self.entries.values() if start <= parse_time(e['start']) <= end]
+        entries.sort(key=lambda e: e['start'])
+        return entries[:TIME_ENTRIES_CAP]
+
+    def me(self, query):
+        """Related data delta, only time entries changed after `since` are included"""
+        since = datetime.fromtimestamp(int(query.get('since', 0)), timezone.utc)
+        with self.entries_lock:
+            changed = [
+                e for e in list(self.entries.values()) + self.tombstones
+                if parse_time(e['at']) > since
+            ]
+        return {
+            'since': int(datetime.now(timezone.utc).timestamp()),
+            'data': {'id': 1, 'time_entries': changed},
+        }
+
+    def detailed_csv(self, query):
+        start = parse_time(query['since'] + 'T00:00:00+00:00')
+        end = parse_time(query['until'] + 'T23:59:59+00:00')
+        projects = {p['id']: p['name'] for p in self.projects}
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['Project', 'Description', 'Start date', 'Start time', 'Duration'])
+        with self.entries_lock:
+            entries = sorted(
+                (e for e in self.entries.values() if start <= parse_time(e['start']) <= end),
+                key=lambda e: e['start'],
+            )
+        for e in entries:
+            started = parse_time(e['start'])
+            writer.writerow([
+                projects.get(e.get('pid'), ''), e.get('description', ''), started.date().isoformat(),
+                started.time().isoformat(), '{0:02d}:{1:02d}:00'.format(*divmod(e['duration'] // 60, 60)),
+            ])
+        return ('\ufeff' + output.getvalue()).encode('utf-8')
+
+
+def point_toggl_to(base_url):
+    """Redirect TogglPy Endpoints to base_url, returns the previous values for restore_toggl"""
+    previous = {}
+    for name, value in vars(Endpoints).items():
+        if isinstance(value, str) and value.startswith(TOGGL_BASE):
+            previous[name] = value
+            setattr(Endpoints, name, base_url + value[len(TOGGL_BASE):])
+    return previous
+
+
+def restore_toggl(previous):
+    for name, value in previous.items():
+        setattr(Endpoints, name, value)
@@ -0,0 +1,237 @@
+"""
+Offline benchmarks of the sync code against local stand-ins of the Toggl and Google Sheets APIs.
+
+    python -m benchmarks.run --sizes week month year --latency 0.05 --toggl-rate 1 --sheets-rate 1
+
+Reports wall time, API calls and peak Python memory (tracemalloc) of every scenario.
+The stand-in servers run in the same process, their allocations are part of the peak.
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from benchmarks.datasets import CLIENTS, PROJECTS, SIZES, SPREADSHEET_ID, TRANSACTIONS_ID, Dataset
+from benchmarks.fake_sheets import FakeSheetsServer, sheets_client
+from benchmarks.fake_toggl import FakeTogglServer, point_toggl_to, restore_toggl
+
+
+# the modules under test read their configuration on import
+os.environ.setdefault('TOGGL_API_KEY', 'benchmark')
+os.environ['SPREADSHEET_ID'] = SPREADSHEET_ID
+
+
+class Environment:
+    """Fresh stand-in servers loaded with a dataset, wired into GoogleSheets and TogglPy"""
+
+    def __init__(self, dataset, args):
+        self.dataset = dataset
+        self.args = args
+        self.toggl = FakeTogglServer(
+            CLIENTS, PROJECTS, dataset.toggl_entries, latency=args.latency, rate_limit=args.toggl_rate
+        )
+        self.sheets = FakeSheetsServer(dataset.spreadsheets(), latency=args.latency, rate_limit=args.sheets_rate)
+        self.state_dir = tempfile.TemporaryDirectory()
+
+    def __enter__(self):
+        from lambdas.lib.google_sheets import GoogleSheets
+        from lambdas.lib.sheet_cache import SheetValueCache
+        from lambdas.lib.sheets_scheduler import SheetsScheduler
+
+        self.toggl.start()
+        self.sheets.start()
+        self.previous_endpoints = point_toggl_to(self.toggl.base_url)
+        self.previous_client = GoogleSheets.client
+        GoogleSheets.client = sheets_client(self.sheets.base_url)
+        # pace the requests like for the real quota when the stand-in has one, otherwise measure the code alone
+        self.previous_scheduler = GoogleSheets.scheduler
+        per_minute = self.args.sheets_rate * 60 if self.args.sheets_rate else 10 ** 6
+        GoogleSheets.scheduler = SheetsScheduler(per_minute, per_minute, burst=self.args.sheets_rate or 5)
+        self.previous_cache = GoogleSheets.value_cache
+        GoogleSheets.value_cache = SheetValueCache(os.path.join(self.state_dir.name, 'sheet_values.sqlite3'))
+        # local state of the code under test starts empty for every environment
+        self.previous_env = {name: os.environ.get(name) for name in ('SYNC_STATE_DB', 'TOGGL_MIRROR_DB')}
+        os.environ['SYNC_STATE_DB'] = os.path.join(self.state_dir.name, 'sync_state.sqlite3')
+        os.environ['TOGGL_MIRROR_DB'] = os.path.join(self.state_dir.name, 'toggl_mirror.sqlite3')
+        return self
+
+    def __exit__(self, *args):
+        from lambdas.lib.google_sheets import GoogleSheets
+
+        GoogleSheets.client = self.previous_client
+        GoogleSheets.scheduler = self.previous_scheduler
+        GoogleSheets.value_cache = self.previous_cache
+        restore_toggl(self.previous_endpoints)
+        for name, value in self.previous_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        self.toggl.stop()
+        self.sheets.stop()
+        self.state_dir.cleanup()
+
+    def reset_counters(self):
+        self.toggl.reset_counters()
+        self.sheets.reset_counters()
+
+    def measure(self, scenario, func):
+        self.reset_counters()
+        tracemalloc.start()
+        started = time.perf_counter()
+        error = None
+        try:
+            # with METRICS_FORMAT=emf the metrics are printed, they would mix into the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                func()
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+        wall = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {
+            'scenario': scenario,
+            'size': self.dataset.size,
+            'days': SIZES[self.dataset.size],
+            'wall_s': round(wall, 3),
+            'toggl_calls': sum(self.toggl.calls.values()),
+            'sheets_calls': sum(self.sheets.calls.values()),
+            'throttled': self.toggl.throttled + self.sheets.throttled,
+            'kbytes': round((self.toggl.bytes_sent + self.sheets.bytes_sent) / 1024, 1),
+            'peak_mb': round(peak / 2 ** 20, 2),
+            'calls': dict(self.toggl.calls + self.sheets.calls),
+            'error': error,
+        }
+
+
+def start_end(dataset):
+    return datetime.combine(dataset.start, datetime.min.time()), datetime.combine(dataset.end, datetime.min.time())
+
+
+def bench_get_days_in_range(dataset, args):
+    from lambdas.lib.google_sheets import GoogleDailyTimeSheets, GoogleSheets
+
+    start, end = start_end(dataset)
+    with Environment(dataset, args) as env:
+        def run():
+            GoogleSheets.start_run()
+            timesheet = GoogleDailyTimeSheets(doc=SPREADSHEET_ID, sheet=start.strftime('%b %y'))
+            timesheet.get_days_in_range(start, end)
+        yield env.measure('get_days_in_range', run)
+        # a later run of an unchanged spreadsheet, values come from the cache
+        yield env.measure('get_days_in_range (cached)', run)
+
+
+def bench_sync_to_toggl(dataset, args):
+    from lambdas.lib.toggl_wrapper import TogglWrapper
+
+    start, end = start_end(dataset)
+    rows = [
+        {
+            'duration': row['minutes'],
+            'date': row['date'].isoformat(),
+            'comment': row['tasks'],
+            'project': row['project']['name'].lower(),
+        }
+        for row in dataset.rows
+    ]
+    with Environment(dataset, args) as env:
+        def run():
+            TogglWrapper(client_names=['Development', 'Clients']).sync_to_toggl(rows, start, end)
+        yield env.measure('sync_to_toggl', run)
+
+
+def bench_sync_hours(dataset, args):
+    from lambdas.sync_toggl.handler import sync_hours
+
+    start, end = start_end(dataset)
+    with Environment(dataset, args) as env:
+        yield env.measure('sync_hours', lambda: sync_hours(start, end))
+        # an unchanged sheet synced again, as done by the sheet trigger
+        yield env.measure('sync_hours (rerun)', lambda: sync_hours(start, end))
+
+
+def bench_sync_transactions(dataset, args):
+    from lambdas.lib.google_sheets import GoogleTransactionSheets
+
+    with Environment(dataset, args) as env:
+        def write():
+            GoogleTransactionSheets(doc=TRANSACTIONS_ID, sheet='Transactions').sync_transactions(
+                dataset.transactions())
+
+        def update():
+            GoogleTransactionSheets(doc=TRANSACTIONS_ID, sheet='Transactions').sync_transactions(
+                dataset.transactions(booked_ratio=0.1))
+        yield env.measure('sync_transactions (write)', write)
+        yield env.measure('sync_transactions (update)', update)
+
+
+def bench_detailed_report_csv(dataset, args):
+    from lambdas.lib.toggl.TogglPy import Toggl
+
+    params = {'workspace_id': 1, 'since': dataset.start.isoformat(), 'until': dataset.end.isoformat()}
+    with Environment(dataset, args) as env:
+        def download():
+            with tempfile.TemporaryFile() as f:
+                Toggl().getDetailedReportCSV(dict(params), f)
+
+        def iterate():
+            for _ in Toggl().iterDetailedReportCSV(dict(params)):
+                pass
+        yield env.measure('detailed_report_csv (file)', download)
+        yield env.measure('detailed_report_csv (rows)', iterate)
+
+
+BENCHMARKS = {
+    'get_days_in_range': bench_get_days_in_range,
+    'sync_to_toggl': bench_sync_to_toggl,
+    'sync_hours': bench_sync_hours,
+    'sync_transactions': bench_sync_transactions,
+    'detailed_report_csv': bench_detailed_report_csv,
+}
+
+
+def format_results(results):
+    lines = ['%-28s %-8s %9s %7s %7s %6s %9s %8s' % (
+        'scenario', 'size', 'wall s', 'toggl', 'sheets', '429s', 'kbytes', 'peak MB')]
+    for r in results:
+        lines.append('%-28s %-8s %9.3f %7d %7d %6d %9.1f %8.2f%s' % (
+            r['scenario'], r['size'], r['wall_s'], r['toggl_calls'], r['sheets_calls'], r['throttled'],
+            r['kbytes'], r['peak_mb'], '  ERROR ' + r['error'] if r['error'] else ''))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the sync against local fake APIs')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['week', 'month', 'year'])
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API call')
+    parser.add_argument('--toggl-rate', type=float, default=None, help='Toggl requests per second before 429s')
+    parser.add_argument('--sheets-rate', type=float, default=None, help='Sheets requests per second before 429s')
+    parser.add_argument('--json', help='also write the results with per endpoint call counts to this file')
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = []
+    for size in args.sizes:
+        dataset = Dataset(size)
+        for name in args.only:
+            for result in BENCHMARKS[name](dataset, args):
+                results.append(result)
+                # progress, long runs take a while with latency and rate limits
+                print(format_results([result]).splitlines()[-1], file=sys.stderr)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Base of the in-process stand-in HTTP servers used by the benchmarks"""
+import gzip
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+class RateLimiter:
+    """Token bucket answering whether a request is allowed right now"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class FakeServer:
+    """
+    Threaded HTTP server dispatching to `route(method, path, query, body)` of subclasses.
+    Every request is delayed by `latency` seconds and requests over `rate_limit` per second get a 429.
+    Responses are gzipped for clients sending Accept-Encoding: gzip, unless `compress` is False.
+    """
+    name = 'fake'
+    # smaller bodies are sent as they are, like most servers do
+    min_compress_size = 1024
+
+    def __init__(self, latency=0.0, rate_limit=None, compress=True):
+        self.latency = latency
+        self.compress = compress
+        self.limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.calls = Counter()
+        self.throttled = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%s' % self.httpd.server_port
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls.clear()
+            self.throttled = 0
+            self.bytes_sent = 0
+
+    def route(self, method, path, query, body):
+        """Return (status, payload), payload is JSON encoded unless it is bytes already"""
+        raise NotImplementedError
+
+    def call_label(self, method, path):
+        """Key of the call counter, numeric ids are folded so the counts aggregate"""
+        parts = ['{id}' if part.isdigit() else part for part in path.split('/')]
+        return '%s %s' % (method, '/'.join(parts))
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def handle_any(self):
+                url = urlsplit(self.path)
+                path = unquote(url.path)
+                query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                if server.latency:
+                    time.sleep(server.latency)
+                if server.limiter and not server.limiter.allow():
+                    with server.lock:
+                        server.throttled += 1
+                    status, payload = 429, {'error': {'code': 429, 'message': 'Rate limit exceeded'}}
+                    extra = {'Retry-After': '1'}
+                else:
+                    with server.lock:
+                        server.calls[server.call_label(self.command, path)] += 1
+                    status, payload = server.route(self.command, path, query, json.loads(body) if body else None)
+                    extra = {}
+                if isinstance(payload, bytes):
+                    data, content_type = payload, 'application/octet-stream'
+                else:
+                    data, content_type = json.dumps(payload).encode('utf-8'), 'application/json'
+                accepts_gzip = 'gzip' in (self.headers.get('Accept-Encoding') or '')
+                if server.compress and accepts_gzip and len(data) >= server.min_compress_size:
+                    data = gzip.compress(data)
+                    extra['Content-Encoding'] = 'gzip'
+                with server.lock:
+                    server.bytes_sent += len(data)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in extra.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = handle_any
+
+        return Handler
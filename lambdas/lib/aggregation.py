@@ -0,0 +1,111 @@
+"""
+Local totals of annotated time entries (see TogglWrapper.get_annotated_time_entries),
+instead of a Toggl summary or weekly report round trip per question.
+
+Entries are stored column-wise and grouped in one pass, with NumPy when it is installed.
+"""
+from datetime import date
+
+from lambdas.lib.toggl.TogglPy import Toggl
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# columns available for grouping
+GROUPINGS = ('employee', 'project', 'client', 'day', 'week', 'month')
+
+
+class EntryTable:
+    def __init__(self, entries_by_employee):
+        """
+        :param entries_by_employee: {employee: [annotated time entry, ...]}, use from_entries for a single person
+        """
+        columns = {name: [] for name in GROUPINGS}
+        seconds = []
+        for employee, entries in entries_by_employee.items():
+            for entry in entries:
+                # running entries have a negative duration
+                if entry['duration'] < 0:
+                    continue
+                day = Toggl.parseTime(entry['start']).date()
+                iso_year, iso_week, _ = day.isocalendar()
+                columns['employee'].append(employee)
+                columns['project'].append(entry.get('project_name') or '')
+                columns['client'].append(entry.get('client_name') or '')
+                columns['day'].append(day.isoformat())
+                columns['week'].append('%04d-W%02d' % (iso_year, iso_week))
+                columns['month'].append(day.strftime('%Y-%m'))
+                seconds.append(entry['duration'])
+        if np is not None:
+            self.columns = {name: np.asarray(values, dtype=str) for name, values in columns.items()}
+            self.seconds = np.asarray(seconds, dtype=np.float64)
+        else:
+            self.columns = columns
+            self.seconds = seconds
+
+    @classmethod
+    def from_entries(cls, entries, employee=''):
+        return cls({employee: entries})
+
+    def __len__(self):
+        return len(self.seconds)
+
+    def totals(self, by='project'):
+        """
+        Hours grouped by one column name or a tuple of them, e.g. totals(('employee', 'month')).
+        Keys are the column values, tuples of them when grouping by several columns.
+        """
+        by = (by,) if isinstance(by, str) else tuple(by)
+        for name in by:
+            if name not in GROUPINGS:
+                raise ValueError(f"Can not group by {name}, should be one of {GROUPINGS}")
+        if not len(self):
+            return {}
+        if np is not None:
+            return self._totals_numpy(by)
+        totals = {}
+        for i, duration in enumerate(self.seconds):
+            key = tuple(self.columns[name][i] for name in by)
+            totals[key] = totals.get(key, 0) + duration
+        return {(key[0] if len(by) == 1 else key): round(total / 3600, 2) for key, total in sorted(totals.items())}
+
+    def _totals_numpy(self, by):
+        uniques = []
+        codes = []
+        for name in by:
+            values, inverse = np.unique(self.columns[name], return_inverse=True)
+            uniques.append(values)
+            codes.append(inverse)
+        # one integer per group combination, summed with a single bincount
+        flat = np.ravel_multi_index(codes, [len(values) for values in uniques])
+        groups, inverse = np.unique(flat, return_inverse=True)
+        sums = np.bincount(inverse, weights=self.seconds) / 3600
+        indexes = np.unravel_index(groups, [len(values) for values in uniques])
+        totals = {}
+        for i, total in enumerate(sums):
+            key = tuple(str(values[index[i]]) for values, index in zip(uniques, indexes))
+            totals[key[0] if len(by) == 1 else key] = round(float(total), 2)
+        return totals
+
+    def monthly_hours(self, client=None):
+        """
+        {employee: {first day of month: hours}}, as needed by GoogleYearlyHoursSection.set_monthly_hours.
+        :param client: only count the entries of this Toggl client
+        """
+        if client is None:
+            totals = self.totals(('employee', 'month'))
+        else:
+            totals = {
+                (employee, month): hours
+                for (employee, entry_client, month), hours
+                in self.totals(('employee', 'client', 'month')).items()
+                if entry_client == client
+            }
+        result = {}
+        for (employee, month), hours in totals.items():
+            year, month_number = month.split('-')
+            result.setdefault(employee, {})[date(int(year), int(month_number), 1)] = hours
+        return result
@@ -1,37 +1,177 @@
+import hashlib
+import itertools
+import json
 import os
+import tempfile
 import gspread
-import string
 import logging
 from datetime import date, datetime
+from operator import itemgetter
+from lambdas.lib import sheets_scheduler
+from lambdas.lib.instrumentation import instrumentation
+from lambdas.lib.sheet_cache import SheetValueCache
+
+
+# worksheet methods modifying the sheet, all other calls are reads
+WORKSHEET_WRITE_METHODS = (
+    'update', 'update_cell', 'update_cells', 'update_acell', 'batch_update', 'format',
+    'append_row', 'append_rows', 'insert_row', 'insert_rows', 'delete_rows', 'clear',
+    'batch_clear', 'add_rows', 'add_cols', 'resize', 'insert_cols', 'delete_row', 'delete_columns',
+    'delete_dimension', 'merge_cells', 'sort', 'freeze', 'update_title', 'update_index', 'update_note',
+    'insert_note', 'clear_note', 'set_basic_filter', 'clear_basic_filter', 'columns_auto_resize',
+)
+# writes which are applied again when a request with a lost response is resent
+WORKSHEET_APPEND_METHODS = (
+    'append_row', 'append_rows', 'insert_row', 'insert_rows', 'delete_rows',
+    'add_rows', 'add_cols', 'insert_cols', 'delete_row', 'delete_columns', 'delete_dimension',
+)
+# rows per request of bulk writes, keeps requests well below the Sheets API payload limit
+WRITE_CHUNK_ROWS = int(os.environ.get('SHEETS_WRITE_CHUNK_ROWS', 500))
+
+
+class HeaderSchema:
+    """
+    Header row of a sheet compiled once: column numbers and A1 letters by slug, the columns
+    without header, and a projection of value rows to records which tolerates short rows.
+    """
+
+    def __init__(self, header_values):
+        self.headers = [self.slugify(value) for value in header_values]
+        self.width = len(self.headers)
+        # 1 based column by slug, the first one wins for duplicate headers
+        self.columns = {}
+        for col, key in enumerate(self.headers, 1):
+            if key and key not in self.columns:
+                self.columns[key] = col
+        self.letters = {key: self.column_letter(col) for key, col in self.columns.items()}
+        # 0 based indexes of the columns without header, they are left out of the records
+        self.skipped = tuple(i for i, key in enumerate(self.headers) if not key)
+        fields = [(i, key) for i, key in enumerate(self.headers) if key]
+        self.keys = tuple(key for _, key in fields)
+        indexes = [i for i, _ in fields]
+        if len(indexes) == 1:
+            self.getter = lambda row: (row[indexes[0]],)
+        else:
+            self.getter = itemgetter(*indexes) if indexes else lambda row: ()
+
+    @staticmethod
+    def slugify(key):
+        return key.lower().strip().replace(' ', '_')
+
+    @staticmethod
+    def column_letter(col):
+        """A1 letters of a 1 based column number, e.g. 28 is AB"""
+        letters = ''
+        while col:
+            col, remainder = divmod(col - 1, 26)
+            letters = chr(ord('A') + remainder) + letters
+        return letters
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def column(self, key):
+        col = self.columns.get(key)
+        if col is None:
+            raise ValueError(f"Wrong key {key}, should be one of {list(self.columns)}")
+        return col
+
+    def cell(self, key, row):
+        """A1 notation of the cell of the column in the given row, e.g. C7"""
+        self.column(key)
+        return f'{self.letters[key]}{row}'
+
+    def rows_range(self, first_row, last_row):
+        """A1 range spanning all header columns of the rows, e.g. A2:AB30"""
+        return f'A{first_row}:{self.column_letter(self.width)}{last_row}'
+
+    def record(self, row):
+        """Dict of the values of a row by slug, cells missing at the end of short rows are empty"""
+        if len(row) < self.width:
+            row = list(row) + [''] * (self.width - len(row))
+        return dict(zip(self.keys, self.getter(row)))
+
+    def records(self, rows):
+        return [self.record(row) for row in rows]
+
+    def values(self, record):
+        """Row of values in column order from a dict by slug, None for columns missing in the dict"""
+        return [record.get(key) for key in self.headers]
 
 
 class GoogleSheets:
+    # gspread client shared by all sheets, authorized once per process
+    client = None
+    # every API call of the process is paced within the Sheets quotas by the same scheduler
+    scheduler = sheets_scheduler.scheduler
+    # values of unchanged spreadsheets are read from disk when SHEETS_CACHE_DB is set, see get_value_cache
+    value_cache = None
+
     def __init__(self, doc, sheet, header_row=1, last_data_row=None):
-        # make sure the sheet is shared with developer@t5-local-test.iam.gserviceaccount.com
-        # filepath = os.path.abspath(os.path.join(__file__, 'credentials_t5.json'))
-        credentials_file = os.environ.get('GOOGLE_CREDENTIALS')
-        filepath = os.path.join(os.path.dirname(__file__), credentials_file)
-        gc = gspread.service_account(filename=filepath)
+        gc = self.get_client()
         self.doc_name = doc
-        if doc.startswith('https://'):
-            self.doc = gc.open_by_url(doc)
-        else:
-            self.doc = gc.open_by_key(doc)
+        self.doc = self.scheduler.read(('open', doc), lambda: self.open_spreadsheet(gc, doc), 'open')
         self.sheet_name = sheet
-        self.sheet = self.doc.worksheet(sheet)
-        self.headers = [self.slugify(e) for e in self.sheet.row_values(header_row)]
+        worksheet = self.scheduler.read(
+            ('worksheet', doc, sheet), lambda: self.doc.worksheet(sheet), 'spreadsheet.worksheet'
+        )
+        self.sheet = self.scheduler.wrap(worksheet, (doc, sheet), WORKSHEET_WRITE_METHODS, WORKSHEET_APPEND_METHODS)
+        value_cache = self.get_value_cache()
+        if value_cache:
+            self.sheet = value_cache.wrap(self.sheet, self.doc.id, sheet, self.fetch_revision)
+        self.schema = HeaderSchema(self.sheet.row_values(header_row))
+        self.headers = self.schema.headers
         self.first_data_row = header_row + 1
         self.last_data_row = last_data_row
 
     @staticmethod
-    def slugify(key):
-        return key.lower().strip().replace(' ', '_')
+    def open_spreadsheet(gc, doc):
+        if doc.startswith('https://'):
+            return gc.open_by_url(doc)
+        return gc.open_by_key(doc)
+
+    def fetch_revision(self):
+        """Version and modification time of the spreadsheet, both change with every edit"""
+        def fetch():
+            response = self.get_client().request(
+                'get', f'{gspread.urls.DRIVE_FILES_API_V3_URL}/{self.doc.id}',
+                params={'fields': 'version,modifiedTime', 'supportsAllDrives': True},
+            )
+            metadata = response.json()
+            return f"{metadata['version']}/{metadata['modifiedTime']}"
+        return self.scheduler.read(('revision', self.doc.id), fetch, 'files.get', service='drive')
+
+    @classmethod
+    def start_run(cls):
+        """Called at the start of every sync, cached values are validated again once"""
+        if GoogleSheets.value_cache:
+            GoogleSheets.value_cache.reset()
+
+    @classmethod
+    def get_value_cache(cls):
+        if GoogleSheets.value_cache is None:
+            GoogleSheets.value_cache = SheetValueCache.from_env()
+        return GoogleSheets.value_cache
+
+    @classmethod
+    def get_client(cls):
+        if GoogleSheets.client is None:
+            # make sure the sheet is shared with developer@t5-local-test.iam.gserviceaccount.com
+            # filepath = os.path.abspath(os.path.join(__file__, 'credentials_t5.json'))
+            credentials_file = os.environ.get('GOOGLE_CREDENTIALS')
+            filepath = os.path.join(os.path.dirname(__file__), credentials_file)
+            GoogleSheets.client = gspread.service_account(filename=filepath)
+        hooks = GoogleSheets.client.session.hooks['response']
+        if instrumentation.record_response not in hooks:
+            # status and bytes of every response are added to the running call
+            hooks.append(instrumentation.record_response)
+        return GoogleSheets.client
+
+    slugify = staticmethod(HeaderSchema.slugify)
 
     def find_row(self, **kwargs):
         for key, value in kwargs.items():
-            if key not in self.headers:
-                raise ValueError(f"Wrong key {key}, should be one of {self.headers}")
-            all_column = self.sheet.col_values(self.headers.index(key) + 1)
+            all_column = self.sheet.col_values(self.schema.column(key))
             if self.last_data_row:
                 column_date = all_column[self.first_data_row - 1:self.last_data_row - 1]
             else:
@@ -54,13 +194,10 @@ class GoogleSheets:
         if self.last_data_row and row > self.last_data_row:
             raise ValueError(f'Row {index} is outside of editable section: last row is {self.last_data_row}')
 
-        slug_headers = [self.slugify(k) for k in self.headers]
-        for key, value in kwargs.items():
-            if key not in slug_headers:
-                raise ValueError('Key %s is missing in headers' % key)
-            col = slug_headers.index(key) + 1
-            self.sheet.update_cell(row, col, value)
-        # self.sheet.values_append(self.sheet, {'valueInputOption': 'USER_ENTERED'}, {'values': put_values})
+        # all cells of the row in one request
+        cells = [{'range': self.schema.cell(key, row), 'values': [[value]]} for key, value in kwargs.items()]
+        if cells:
+            self.sheet.batch_update(cells, value_input_option='USER_ENTERED')
 
     def get_range_dicts(self, first_row=0, last_row=None, row_amount=None):
         # if not first_row:
@@ -75,15 +212,7 @@ class GoogleSheets:
         else:
             list_of_lists = all_values[first_row_absolute:]
         # cast to dicts
-        list_of_dicts = []
-        for row in list_of_lists:
-            row_dict = {}
-            for i, key in enumerate(self.headers):
-                if not key:
-                    continue
-                row_dict[key] = row[i]
-            list_of_dicts.append(row_dict)
-        return list_of_dicts
+        return self.schema.records(list_of_lists)
 
 
 class GoogleSheetSection(GoogleSheets):
@@ -183,24 +312,78 @@ class GoogleDailyTimeSheets(GoogleSheets):
 
 class GoogleTransactionSheets(GoogleSheets):
 
-    def write_transactions(self, transactions):
-        rows = []
-        for tr in transactions:
-            row = []
-            for header in self.headers:
-                # try to avoid overriding
-                value = tr.meta.get(header)
-                row.append(value)
-            rows.append(row)
-        row_start = 'A%s' % self.first_data_row
-        end_letter = (string.ascii_lowercase[len(self.headers)-1]).upper()
-        end_number = len(rows) + self.first_data_row - 1
-        row_end = '%s%s' % (end_letter, end_number)
-        self.sheet.update(f"{row_start}:{row_end}", rows)
+    def write_transactions(self, transactions, chunk_size=WRITE_CHUNK_ROWS, checkpoint=True):
+        """
+        Write transactions (any iterable, consumed lazily) below the headers, chunk_size rows per request.
+        With checkpoint the number and a hash of the written rows are kept in a file after every chunk, so a failed
+        export started again with the same transactions in the same order continues after the last written chunk.
+        If they do not match the checkpoint, a list or other re-iterable is written again from the start,
+        an iterator raises ValueError and has to be passed again fresh.
+        """
+        checkpoint_file = self.checkpoint_path() if checkpoint else None
+        written, digest, transactions = self.resume_transactions(transactions, checkpoint_file)
+        if written:
+            logging.info(f"Resuming export to {self.sheet_name} after {written} written rows")
+        while True:
+            chunk = list(itertools.islice(transactions, chunk_size))
+            if not chunk:
+                break
+            # try to avoid overriding
+            rows = [self.schema.values(tr.meta) for tr in chunk]
+            first_row = self.first_data_row + written
+            self.sheet.update(self.schema.rows_range(first_row, first_row + len(rows) - 1), rows)
+            written += len(rows)
+            if checkpoint_file:
+                self.hash_rows(digest, rows)
+                self.save_checkpoint(checkpoint_file, written, digest.hexdigest())
+        if checkpoint_file and os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        return written
+
+    def checkpoint_path(self):
+        key = hashlib.sha256(f'{self.doc_name}/{self.sheet_name}'.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(os.environ.get('SHEETS_CHECKPOINT_DIR', tempfile.gettempdir()), f'sheet_export_{key}.json')
+
+    @staticmethod
+    def hash_rows(digest, rows):
+        for row in rows:
+            digest.update(json.dumps(row, default=str).encode('utf-8') + b'\n')
 
+    @staticmethod
+    def save_checkpoint(path, written, digest):
+        # replaced atomically, an interruption never leaves a half written checkpoint
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'written': written, 'digest': digest}, f)
+        os.replace(path + '.tmp', path)
+
+    def resume_transactions(self, transactions, checkpoint_file):
+        """
+        Skip the transactions written before according to the checkpoint, hashing their rows on the way,
+        return how many were skipped, the hash of their rows and the iterator of the remaining ones.
+        If the rows of the skipped transactions do not match the checkpoint, the checkpoint is removed and
+        the export starts over from a new iterator, ValueError when the transactions are a consumed iterator.
+        """
+        digest = hashlib.sha256()
+        remaining = iter(transactions)
+        if not checkpoint_file or not os.path.exists(checkpoint_file):
+            return 0, digest, remaining
+        with open(checkpoint_file) as f:
+            state = json.load(f)
+        skipped = 0
+        for tr in itertools.islice(remaining, state['written']):
+            self.hash_rows(digest, [self.schema.values(tr.meta)])
+            skipped += 1
+        if skipped == state['written'] and skipped and digest.hexdigest() == state.get('digest'):
+            return skipped, digest, remaining
+        logging.warning("Export checkpoint does not match the transactions, writing all of them again")
+        os.remove(checkpoint_file)
+        if skipped and remaining is transactions:
+            raise ValueError("Export checkpoint did not match and the transactions are consumed, pass them again")
+        return 0, hashlib.sha256(), iter(transactions)
 
     def sync_transactions(self, transactions):
-        list_of_dicts = self.sheet.get_all_records()
+        # records by slug of the header schema, short rows included
+        list_of_dicts = self.get_range_dicts()
         for t in transactions:
             if 'privat' in t.meta['message']:
                 logging.info("Please book this transaction as private and start over")
@@ -218,20 +401,20 @@ class GoogleTransactionSheets(GoogleSheets):
             if tr.meta.get('id') and str(row['id']) != str(tr.id):
                 breakpoint()
                 raise ValueError("Rows dont match: %s" % row)
-            elif tr.meta.get('status') == 'booked' and row['Status'] != 'booked':
+            elif tr.meta.get('status') == 'booked' and row['status'] != 'booked':
                 # transaction was booked meanwhile
                 i = transactions.index(tr)
                 self.update_row(i, status="booked")
             # update order details: link and supplier name
-            if tr.meta.get('link') and tr.meta['link'] != row['Link']:
+            if tr.meta.get('link') and tr.meta['link'] != row['link']:
                 i = transactions.index(tr)
                 self.update_row(i, link=tr.meta.get('link'))
 
-            if tr.meta.get('supplier') and tr.meta['supplier'] != row['Supplier']:
+            if tr.meta.get('supplier') and tr.meta['supplier'] != row['supplier']:
                 i = transactions.index(tr)
                 self.update_row(i, supplier=tr.meta.get('supplier'))
 
-            tr.meta['status'] = row['Status']
+            tr.meta['status'] = row['status']
 
     def highlight(self, row, color='green'):
         i = self.first_data_row + row
@@ -258,7 +441,7 @@ class GoogleTransactionSheets(GoogleSheets):
             },
 
         }
-        self.sheet.format(f"A{i}:J{i}", {
+        self.sheet.format(self.schema.rows_range(i, i), {
             "backgroundColor": color_dict[color]
             # "horizontalAlignment": "CENTER",
             # "textFormat": {
@@ -276,7 +459,7 @@ class GoogleTransactionSheets(GoogleSheets):
         if row < 0:
             return
         i = self.first_data_row + row
-        self.sheet.format(f"A{i}:J{i}", {
+        self.sheet.format(self.schema.rows_range(i, i), {
             "backgroundColor": {
                 "red": 1,
                 "green": 1,
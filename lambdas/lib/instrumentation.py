@@ -0,0 +1,285 @@
+"""
+Timing and metrics of the calls to Toggl and Google Sheets.
+
+Every call is described by a CallRecord and passed to the registered hooks.
+The process-wide `instrumentation` always aggregates the records into Metrics,
+which can be logged as a summary or emitted as CloudWatch embedded metric format (EMF).
+"""
+import cProfile
+import io
+import json
+import logging
+import pstats
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+
+# latency histogram bucket upper bounds in milliseconds
+LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+
+class CallRecord:
+    def __init__(self, service, endpoint, method):
+        self.service = service
+        self.endpoint = endpoint
+        self.method = method
+        self.latency = None  # seconds, without the time throttled
+        self.throttled = 0.0  # seconds waited for a client side rate limit
+        self.bytes = None
+        self.status = None
+        self.retries = 0
+        self.error = None
+
+    def retried(self, *args):
+        """Callback for RetryPolicy.call(on_retry=...)"""
+        self.retries += 1
+
+    def throttle(self, limiter):
+        """Acquire a token of the rate limiter, the time waited is kept out of the latency"""
+        self.throttled += limiter.acquire()
+
+    def response(self, status, size):
+        """Status and bytes on the wire of a response, the bytes of retried attempts add up"""
+        self.status = status
+        self.bytes = (self.bytes or 0) + size
+
+    def as_dict(self):
+        return {
+            'service': self.service,
+            'endpoint': self.endpoint,
+            'method': self.method,
+            'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+            'throttled_ms': round(self.throttled * 1000, 1),
+            'bytes': self.bytes,
+            'status': self.status,
+            'retries': self.retries,
+            'error': self.error,
+        }
+
+
+class Metrics:
+    """In-process counters and latency histograms, grouped by service, method and endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def __call__(self, record):
+        key = (record.service, record.method, record.endpoint)
+        latency_ms = (record.latency or 0) * 1000
+        with self.lock:
+            stat = self.stats.get(key)
+            if stat is None:
+                stat = self.stats[key] = {
+                    'calls': 0, 'errors': 0, 'retries': 0, 'bytes': 0,
+                    'latency_total': 0.0, 'latency_max': 0.0, 'throttled': 0.0,
+                    'buckets': [0] * len(LATENCY_BUCKETS),
+                }
+            stat['calls'] += 1
+            stat['errors'] += 1 if record.error else 0
+            stat['retries'] += record.retries
+            stat['bytes'] += record.bytes or 0
+            stat['latency_total'] += latency_ms
+            stat['latency_max'] = max(stat['latency_max'], latency_ms)
+            stat['throttled'] += record.throttled * 1000
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency_ms <= bound:
+                    stat['buckets'][i] += 1
+                    break
+
+    @staticmethod
+    def percentile(stat, fraction):
+        """Upper bound of the histogram bucket holding the given fraction of calls"""
+        threshold = stat['calls'] * fraction
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, stat['buckets']):
+            seen += count
+            if seen >= threshold:
+                return min(bound, stat['latency_max'])
+        return stat['latency_max']
+
+    def summary(self):
+        with self.lock:
+            stats = {key: dict(stat) for key, stat in self.stats.items()}
+        rows = []
+        for (service, method, endpoint), stat in sorted(stats.items(), key=lambda i: -i[1]['latency_total']):
+            rows.append({
+                'service': service,
+                'method': method,
+                'endpoint': endpoint,
+                'calls': stat['calls'],
+                'errors': stat['errors'],
+                'retries': stat['retries'],
+                'bytes': stat['bytes'],
+                'latency_total_ms': round(stat['latency_total'], 1),
+                'latency_avg_ms': round(stat['latency_total'] / stat['calls'], 1),
+                'latency_p95_ms': round(self.percentile(stat, 0.95), 1),
+                'latency_max_ms': round(stat['latency_max'], 1),
+                'throttled_ms': round(stat['throttled'], 1),
+            })
+        return rows
+
+    def format_summary(self):
+        lines = ['%-8s %-6s %-48s %6s %6s %8s %10s %8s %10s' % (
+            'service', 'method', 'endpoint', 'calls', 'retry', 'kbytes', 'total ms', 'p95 ms', 'wait ms')]
+        for row in self.summary():
+            lines.append('%-8s %-6s %-48s %6d %6d %8.1f %10.1f %8.1f %10.1f' % (
+                row['service'], row['method'], row['endpoint'][:48], row['calls'], row['retries'],
+                row['bytes'] / 1024, row['latency_total_ms'], row['latency_p95_ms'], row['throttled_ms']))
+        return '\n'.join(lines)
+
+    def to_emf(self, namespace='SyncToggl'):
+        """Return one CloudWatch EMF JSON document per line, ready to be printed to the Lambda log"""
+        timestamp = int(time.time() * 1000)
+        documents = []
+        for row in self.summary():
+            documents.append(json.dumps({
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [['Service', 'Endpoint']],
+                        'Metrics': [
+                            {'Name': 'Calls', 'Unit': 'Count'},
+                            {'Name': 'Errors', 'Unit': 'Count'},
+                            {'Name': 'Retries', 'Unit': 'Count'},
+                            {'Name': 'Bytes', 'Unit': 'Bytes'},
+                            {'Name': 'LatencyTotal', 'Unit': 'Milliseconds'},
+                            {'Name': 'LatencyP95', 'Unit': 'Milliseconds'},
+                            {'Name': 'Throttled', 'Unit': 'Milliseconds'},
+                        ],
+                    }],
+                },
+                'Service': row['service'],
+                'Endpoint': f"{row['method']} {row['endpoint']}",
+                'Calls': row['calls'],
+                'Errors': row['errors'],
+                'Retries': row['retries'],
+                'Bytes': row['bytes'],
+                'LatencyTotal': row['latency_total_ms'],
+                'LatencyP95': row['latency_p95_ms'],
+                'Throttled': row['throttled_ms'],
+            }))
+        return '\n'.join(documents)
+
+
+class InstrumentedProxy:
+    """Wraps an API object (e.g. a gspread Worksheet) so that each method call is recorded"""
+
+    def __init__(self, target, instrumentation, service, name, write_methods=()):
+        self._target = target
+        self._instrumentation = instrumentation
+        self._service = service
+        self._name = name
+        self._write_methods = write_methods
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if not callable(value):
+            return value
+
+        method = 'WRITE' if attr in self._write_methods else 'READ'
+
+        def call(*args, **kwargs):
+            with self._instrumentation.call(self._service, f'{self._name}.{attr}', method):
+                return value(*args, **kwargs)
+        return call
+
+
+class Instrumentation:
+    def __init__(self):
+        self.hooks = []
+        # record of the running call per thread, responses are added to it by record_response
+        self.local = threading.local()
+        self.metrics = Metrics()
+        self.add_hook(self.metrics)
+
+    def add_hook(self, hook):
+        """Register a callable receiving every finished CallRecord"""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    @staticmethod
+    def normalize_endpoint(url):
+        """Drop the query and replace numeric ids, so endpoints aggregate well"""
+        path = url.split('?', 1)[0].split('://', 1)[-1]
+        path = path.split('/', 1)[1] if '/' in path else path
+        return '/' + re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+    def current(self):
+        """Record of the call running in this thread, None outside of calls"""
+        return getattr(self.local, 'record', None)
+
+    def record_response(self, response, *args, **kwargs):
+        """requests response hook, adds status and bytes of every response to the call running in this thread"""
+        record = self.current()
+        if record is not None:
+            length = response.headers.get('Content-Length')
+            record.response(response.status_code, int(length) if length and length.isdigit() else len(response.content))
+
+    @contextmanager
+    def call(self, service, endpoint, method, collect_responses=True):
+        """
+        Time the block and pass its CallRecord to the hooks.
+        :param collect_responses: the record receives the responses of record_response in this thread,
+            disable it for calls held open across the yields of a generator
+        """
+        record = CallRecord(service, endpoint, method)
+        parent = self.current()
+        if collect_responses:
+            self.local.record = record
+        started = time.perf_counter()
+        try:
+            yield record
+        except Exception as error:
+            record.error = type(error).__name__
+            record.status = record.status or getattr(error, 'code', None) or getattr(
+                getattr(error, 'response', None), 'status_code', None)
+            raise
+        finally:
+            record.latency = time.perf_counter() - started - record.throttled
+            if collect_responses:
+                self.local.record = parent
+            for hook in list(self.hooks):
+                try:
+                    hook(record)
+                except Exception:
+                    logging.exception("Instrumentation hook failed")
+
+    def wrap(self, target, service, name=None, write_methods=()):
+        """Record every method call of target, calls named in write_methods are recorded as WRITE, others as READ"""
+        return InstrumentedProxy(target, self, service, name or type(target).__name__.lower(), write_methods)
+
+    @contextmanager
+    def profile(self, enabled=True, limit=30):
+        """Opt-in cProfile and per-call tracing of a single invocation, both are logged at the end"""
+        if not enabled:
+            yield
+            return
+
+        def trace(record):
+            logging.info("call %s", json.dumps(record.as_dict()))
+
+        profiler = cProfile.Profile()
+        self.add_hook(trace)
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.remove_hook(trace)
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(limit)
+            logging.info("Profile:\n%s", output.getvalue())
+
+
+# process wide instrumentation shared by the Toggl and Google Sheets clients
+instrumentation = Instrumentation()
@@ -0,0 +1,77 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class Pipeline:
+    """
+    Runs the independent stages of a sync next to each other and joins them where their results meet.
+
+    Stages are submitted by name and picked up with result(name). With concurrent=False a stage only runs
+    when its result is first asked for, so stages that turn out to be unneeded cost nothing.
+    The start and duration of every stage are kept for the timing breakdown.
+    """
+
+    def __init__(self, concurrent=True, workers=4):
+        self.concurrent = concurrent
+        self.executor = ThreadPoolExecutor(max_workers=workers) if concurrent else None
+        self.started = time.perf_counter()
+        self.stages = {}
+        # stages of a lazy pipeline which did not run yet
+        self.pending = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.executor:
+            # stages nobody waits for any more are dropped, running ones finish in the background
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def timed(self, name, func, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.timings[name] = (started - self.started, time.perf_counter() - started)
+
+    def submit(self, name, func, *args, **kwargs):
+        if self.concurrent:
+            self.stages[name] = self.executor.submit(self.timed, name, func, *args, **kwargs)
+        else:
+            self.stages[name] = Future()
+            self.pending[name] = (func, args, kwargs)
+
+    def result(self, name):
+        """Wait for the stage and return its result, errors of the stage are raised here"""
+        pending = self.pending.pop(name, None)
+        if pending:
+            func, args, kwargs = pending
+            try:
+                self.stages[name].set_result(self.timed(name, func, *args, **kwargs))
+            except Exception as error:
+                self.stages[name].set_exception(error)
+        return self.stages[name].result()
+
+    def run(self, name, func, *args, **kwargs):
+        """Run a stage in the calling thread, e.g. the step joining the others"""
+        return self.timed(name, func, *args, **kwargs)
+
+    def format_timings(self):
+        with self.lock:
+            timings = sorted(self.timings.items(), key=lambda i: i[1][0])
+        lines = ['%-16s %8s %8s' % ('stage', 'start s', 'took s')]
+        for name, (start, duration) in timings:
+            lines.append('%-16s %8.3f %8.3f' % (name, start, duration))
+        lines.append('%-16s %8s %8.3f' % ('total', '', time.perf_counter() - self.started))
+        return '\n'.join(lines)
+
+    def log_timings(self):
+        logging.info("Sync stages:\n%s", self.format_timings())
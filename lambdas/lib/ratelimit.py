@@ -0,0 +1,60 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket: `rate` tokens per second with bursts up to `burst` tokens.
+    Buckets created with TokenBucket.shared are shared by all clients using the same key (e.g. API token).
+    """
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.capacity = float(max(burst, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, key, rate, burst=1):
+        with cls._shared_lock:
+            bucket = cls._shared.get(key)
+            if bucket is None:
+                bucket = cls._shared[key] = cls(rate, burst)
+            return bucket
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self.paused_until and self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """Block until the tokens are available, return the seconds waited"""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = max(self.paused_until - now, (tokens - self.tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """Hold back every caller of the bucket, e.g. after the server answered with a quota error"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
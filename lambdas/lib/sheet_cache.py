@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+
+
+# worksheet reads whose result only depends on the cell values
+CACHED_METHODS = ('get_all_values', 'get_all_records', 'row_values', 'col_values', 'get_values', 'get')
+
+
+class SheetValueCache:
+    """
+    Worksheet values kept on disk by spreadsheet, tab and read, valid for one revision of the spreadsheet.
+
+    The revision (Drive version and modifiedTime) of a spreadsheet is requested once per run (see reset)
+    and again when it was checked more than `revision_ttl` seconds ago. As long as it did not change,
+    reads are answered from the cache without calling the values API. Any other call through a cached
+    worksheet may modify the sheet and makes the next read check the revision again.
+    """
+
+    def __init__(self, path, revision_ttl=60):
+        self.path = path
+        self.revision_ttl = revision_ttl
+        # spreadsheet id: (revision, monotonic time of the check)
+        self.revisions = {}
+        self.lock = threading.Lock()
+        with self.connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS sheet_values ('
+                ' spreadsheet TEXT NOT NULL,'
+                ' tab TEXT NOT NULL,'
+                ' read TEXT NOT NULL,'
+                ' revision TEXT NOT NULL,'
+                ' payload TEXT NOT NULL,'
+                ' PRIMARY KEY (spreadsheet, tab, read))'
+            )
+
+    @classmethod
+    def from_env(cls):
+        """Cache in the SQLite file SHEETS_CACHE_DB, None when it is not set"""
+        path = os.environ.get('SHEETS_CACHE_DB')
+        if not path:
+            return None
+        return cls(path, revision_ttl=float(os.environ.get('SHEETS_CACHE_REVISION_TTL', 60)))
+
+    @contextmanager
+    def connect(self):
+        """Connection committed on success and closed afterwards"""
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            yield conn
+
+    def reset(self):
+        """Start a new run, the revision of every spreadsheet is requested again on its next read"""
+        with self.lock:
+            self.revisions.clear()
+
+    def forget(self, spreadsheet_id):
+        with self.lock:
+            self.revisions.pop(spreadsheet_id, None)
+
+    def revision(self, spreadsheet_id, fetch):
+        """Revision of the spreadsheet, fetch() is called for the first read of the run and once it is outdated"""
+        with self.lock:
+            revision, checked = self.revisions.get(spreadsheet_id, (None, 0))
+        if revision is None or time.monotonic() - checked > self.revision_ttl:
+            checked = time.monotonic()
+            revision = fetch()
+            with self.lock:
+                self.revisions[spreadsheet_id] = (revision, checked)
+        return revision
+
+    def get(self, spreadsheet_id, tab, read, revision):
+        with self.connect() as conn:
+            row = conn.execute(
+                'SELECT payload FROM sheet_values WHERE spreadsheet = ? AND tab = ? AND read = ? AND revision = ?',
+                (spreadsheet_id, tab, read, revision),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, spreadsheet_id, tab, read, revision, values):
+        with self.connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO sheet_values VALUES (?, ?, ?, ?, ?)',
+                (spreadsheet_id, tab, read, revision, json.dumps(values)),
+            )
+
+    def wrap(self, worksheet, spreadsheet_id, tab, fetch_revision):
+        return CachedWorksheet(worksheet, self, spreadsheet_id, tab, fetch_revision)
+
+
+class CachedWorksheet:
+    """Worksheet answering value reads from a SheetValueCache while the spreadsheet revision is unchanged"""
+
+    def __init__(self, target, cache, spreadsheet_id, tab, fetch_revision):
+        self._target = target
+        self._cache = cache
+        self._spreadsheet_id = spreadsheet_id
+        self._tab = tab
+        self._fetch_revision = fetch_revision
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if not callable(value):
+            return value
+        if attr not in CACHED_METHODS:
+            # every other call may change the sheet, e.g. batch_clear, add_rows or resize
+            def call(*args, **kwargs):
+                try:
+                    return value(*args, **kwargs)
+                finally:
+                    self._cache.forget(self._spreadsheet_id)
+            return call
+
+        def read(*args, **kwargs):
+            # the revision is taken before the read, values changed meanwhile are refreshed on the next run
+            revision = self._cache.revision(self._spreadsheet_id, self._fetch_revision)
+            key = json.dumps([attr, args, sorted(kwargs.items())], default=str)
+            cached = self._cache.get(self._spreadsheet_id, self._tab, key, revision)
+            if cached is not None:
+                logging.debug("Sheet values %s %s served from cache", self._tab, attr)
+                return cached
+            values = value(*args, **kwargs)
+            self._cache.put(self._spreadsheet_id, self._tab, key, revision, values)
+            return values
+        return read
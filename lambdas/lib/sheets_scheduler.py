@@ -0,0 +1,155 @@
+"""
+Scheduling of Google Sheets API calls within the per-minute read and write quotas.
+
+All GoogleSheets instances of a process share one SheetsScheduler: reads and writes take tokens from
+separate buckets, identical reads running at the same time are sent once, and quota errors pause
+the bucket for every caller and are retried with backoff. Every scheduled request is recorded
+by the instrumentation as one call, its retries included.
+"""
+import logging
+import os
+import random
+import threading
+from concurrent.futures import Future
+
+import requests
+from gspread.exceptions import APIError
+
+from lambdas.lib.instrumentation import instrumentation
+from lambdas.lib.ratelimit import TokenBucket
+from lambdas.lib.toggl.retry import REJECTED_STATUS, RETRYABLE_STATUS, RetryPolicy
+
+
+# Sheets API quotas per user and minute, https://developers.google.com/sheets/api/limits
+READS_PER_MINUTE = int(os.environ.get('SHEETS_READS_PER_MINUTE', 60))
+WRITES_PER_MINUTE = int(os.environ.get('SHEETS_WRITES_PER_MINUTE', 60))
+BURST = int(os.environ.get('SHEETS_BURST', 5))
+
+
+class SheetsRetryPolicy(RetryPolicy):
+    """Quota and server errors of the Sheets API, the quota refills within a minute"""
+    service = 'Sheets'
+
+    def __init__(self, max_attempts=6, base_delay=2, max_delay=60, deadline=180):
+        super().__init__(max_attempts, base_delay, max_delay, deadline)
+
+    @staticmethod
+    def status(error):
+        return getattr(getattr(error, 'response', None), 'status_code', None)
+
+    def is_retryable(self, error, idempotent=True):
+        if isinstance(error, APIError):
+            return self.status(error) in (RETRYABLE_STATUS if idempotent else REJECTED_STATUS)
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return idempotent
+        return False
+
+    def delay(self, attempt, error=None):
+        retry_after = error.response.headers.get('Retry-After') if isinstance(error, APIError) else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_delay)
+        return random.uniform(self.base_delay / 2, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class SheetsScheduler:
+    def __init__(self, reads_per_minute=READS_PER_MINUTE, writes_per_minute=WRITES_PER_MINUTE, burst=BURST,
+                 retry_policy=None):
+        """
+        :param reads_per_minute: quota of read requests, bursts included no minute exceeds it
+        :param writes_per_minute: same for the write requests
+        :param burst: requests sent right away before the pace is applied
+        """
+        self.read_bucket = self.bucket(reads_per_minute, burst)
+        self.write_bucket = self.bucket(writes_per_minute, burst)
+        self.retry_policy = retry_policy or SheetsRetryPolicy()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def bucket(per_minute, burst):
+        burst = min(burst, per_minute - 1)
+        return TokenBucket((per_minute - burst) / 60, burst)
+
+    def execute(self, bucket, func, endpoint, method, service='sheets', idempotent=True):
+        with instrumentation.call(service, endpoint, method) as call:
+            def attempt():
+                call.throttle(bucket)
+                return func()
+
+            def on_retry(attempt, error, delay):
+                call.retried()
+                if self.retry_policy.status(error) == 429:
+                    # the quota is shared, hold back every caller instead of only this one
+                    bucket.pause(delay)
+
+            return self.retry_policy.call(attempt, idempotent=idempotent, on_retry=on_retry)
+
+    def read(self, key, func, endpoint, service='sheets'):
+        """
+        Run a read within the read quota. While a read with the same key is running,
+        the caller waits for its result instead of sending the same request again.
+        :param endpoint: name of the call in the instrumentation, e.g. worksheet.get_all_values
+        """
+        with self.lock:
+            running = self.in_flight.get(key)
+            if running is None:
+                future = self.in_flight[key] = Future()
+        if running is not None:
+            logging.debug("Sheets read %s joined a running request", key)
+            return self.copy(running.result())
+        try:
+            result = self.execute(self.read_bucket, func, endpoint, 'READ', service)
+            future.set_result(result)
+            return result
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def write(self, func, endpoint, idempotent=True):
+        """Run a write within the write quota, writes are never merged"""
+        return self.execute(self.write_bucket, func, endpoint, 'WRITE', idempotent=idempotent)
+
+    @staticmethod
+    def copy(result):
+        # every caller may modify its rows, the values of a shared read are copied
+        if isinstance(result, list):
+            return [list(row) if isinstance(row, list) else row for row in result]
+        return result
+
+    def wrap(self, worksheet, key, write_methods=(), append_methods=()):
+        """Route every method call of worksheet through the scheduler, key identifies the worksheet"""
+        return ScheduledProxy(worksheet, self, key, write_methods, append_methods)
+
+
+class ScheduledProxy:
+    """Worksheet whose calls are scheduled by a SheetsScheduler"""
+
+    def __init__(self, target, scheduler, key, write_methods=(), append_methods=()):
+        self._target = target
+        self._scheduler = scheduler
+        self._key = key
+        self._write_methods = write_methods
+        # writes which would be applied twice when a lost response is retried
+        self._append_methods = append_methods
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            endpoint = f'worksheet.{attr}'
+            if attr in self._write_methods:
+                return self._scheduler.write(
+                    lambda: value(*args, **kwargs), endpoint, idempotent=attr not in self._append_methods
+                )
+            key = (self._key, attr, repr(args), repr(sorted(kwargs.items())))
+            return self._scheduler.read(key, lambda: value(*args, **kwargs), endpoint)
+        return call
+
+
+# process wide scheduler shared by all GoogleSheets
+scheduler = SheetsScheduler()
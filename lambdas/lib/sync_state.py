@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta
+
+
+DEFAULT_DB_PATH = os.path.join(tempfile.gettempdir(), 'toggl_sync_state.sqlite3')
+# project key stored for days without any sheet rows, so empty days are remembered too
+EMPTY_DAY = ''
+
+
+class SyncStateBackend(ABC):
+    """Storage interface of SyncStateLedger.
+
+    A record is stored per scope (spreadsheet), date and project and holds the content hash of the
+    synced sheet rows together with the ids of the Toggl entries backing them.
+    """
+
+    @abstractmethod
+    def load(self, scope, dates):
+        """Return {date: {project: {'hash': str, 'entry_ids': list}}} for the given iso dates"""
+
+    @abstractmethod
+    def save(self, scope, days):
+        """Replace all records of every date in `days` ({date: {project: (hash, entry_ids)}})"""
+
+
+class MemorySyncStateBackend(SyncStateBackend):
+    def __init__(self):
+        self.records = {}
+
+    def load(self, scope, dates):
+        return {d: dict(self.records[(scope, d)]) for d in dates if (scope, d) in self.records}
+
+    def save(self, scope, days):
+        for day, projects in days.items():
+            self.records[(scope, day)] = {
+                project: {'hash': content_hash, 'entry_ids': list(entry_ids)}
+                for project, (content_hash, entry_ids)
+                in projects.items()
+            }
+
+
+class SqliteSyncStateBackend(SyncStateBackend):
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        with self.connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS sync_state ('
+                ' scope TEXT NOT NULL,'
+                ' date TEXT NOT NULL,'
+                ' project TEXT NOT NULL,'
+                ' content_hash TEXT NOT NULL,'
+                ' entry_ids TEXT NOT NULL,'
+                ' synced_at REAL NOT NULL,'
+                ' PRIMARY KEY (scope, date, project))'
+            )
+
+    @contextmanager
+    def connect(self):
+        """Connection committed on success and closed afterwards"""
+        # a connection per operation keeps the backend usable from worker threads
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            yield conn
+
+    def load(self, scope, dates):
+        dates = list(dates)
+        result = {}
+        if not dates:
+            return result
+        with self.connect() as conn:
+            # stay well below the sqlite host parameter limit for multi-year ranges
+            for i in range(0, len(dates), 500):
+                chunk = dates[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(
+                    f'SELECT date, project, content_hash, entry_ids FROM sync_state '
+                    f'WHERE scope = ? AND date IN ({placeholders})',
+                    [scope, *chunk],
+                )
+                for day, project, content_hash, entry_ids in rows:
+                    result.setdefault(day, {})[project] = {
+                        'hash': content_hash,
+                        'entry_ids': json.loads(entry_ids),
+                    }
+        return result
+
+    def save(self, scope, days):
+        now = time.time()
+        with self.connect() as conn:
+            for day, projects in days.items():
+                conn.execute('DELETE FROM sync_state WHERE scope = ? AND date = ?', (scope, day))
+                conn.executemany(
+                    'INSERT INTO sync_state (scope, date, project, content_hash, entry_ids, synced_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    [
+                        (scope, day, project, content_hash, json.dumps(list(entry_ids)), now)
+                        for project, (content_hash, entry_ids)
+                        in projects.items()
+                    ],
+                )
+
+
+class SyncStateLedger:
+    """Remembers what was synced per date and project, so unchanged days can be skipped.
+
+    Rows are expected in the toggl format produced by sync_hours:
+    {'duration': int, 'date': 'YYYY-MM-DD', 'comment': str, 'project': str}
+    """
+
+    def __init__(self, scope, backend=None):
+        self.scope = scope
+        self.backend = backend or SqliteSyncStateBackend()
+
+    @classmethod
+    def from_env(cls, scope):
+        path = os.environ.get('SYNC_STATE_DB') or DEFAULT_DB_PATH
+        return cls(scope, backend=SqliteSyncStateBackend(path))
+
+    @staticmethod
+    def hash_rows(rows):
+        canonical = sorted(json.dumps(row, sort_keys=True, default=str) for row in rows)
+        return hashlib.sha256('\n'.join(canonical).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def date_range(start, end):
+        """Iso dates from start till end, both included"""
+        day = start.date() if isinstance(start, datetime) else start
+        last = end.date() if isinstance(end, datetime) else end
+        while day <= last:
+            yield day.isoformat()
+            day += timedelta(days=1)
+
+    def fingerprint(self, rows, start, end):
+        """Group rows into {date: {project: hash}} for every day of the range"""
+        grouped = {day: {} for day in self.date_range(start, end)}
+        for row in rows:
+            grouped.setdefault(row['date'], {}).setdefault(row.get('project', ''), []).append(row)
+        return {
+            day: {project: self.hash_rows(p_rows) for project, p_rows in projects.items()}
+            or {EMPTY_DAY: self.hash_rows([])}
+            for day, projects in grouped.items()
+        }
+
+    def changed_dates(self, rows, start, end):
+        """Return sorted iso dates whose sheet content differs from the last recorded sync"""
+        current = self.fingerprint(rows, start, end)
+        stored = self.backend.load(self.scope, current.keys())
+        changed = []
+        for day, projects in current.items():
+            known = {project: record['hash'] for project, record in stored.get(day, {}).items()}
+            if known != projects:
+                changed.append(day)
+        return sorted(changed)
+
+    def record(self, rows, dates, entry_ids=None):
+        """Store the state of `dates` after a successful sync.
+
+        :param entry_ids: {(date, project): [toggl entry id, ...]} as returned by TogglWrapper.sync_to_toggl
+        """
+        entry_ids = entry_ids or {}
+        dates = set(dates)
+        day_rows = {day: [] for day in dates}
+        for row in rows:
+            if row['date'] in dates:
+                day_rows[row['date']].append(row)
+        days = {}
+        for day in dates:
+            fingerprint = self.fingerprint(day_rows[day], datetime.fromisoformat(day), datetime.fromisoformat(day))
+            days[day] = {
+                project: (content_hash, entry_ids.get((day, project), []))
+                for project, content_hash in fingerprint[day].items()
+            }
+        self.backend.save(self.scope, days)
@@ -2,12 +2,26 @@
 TogglPy is a non-cluttered, easily understood and implemented
 library for interacting with the Toggl API.
 """
+import csv
+import io
 import json  # parsing json data
 import math
 import sys
 import time
+import zlib
 from base64 import b64encode
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from lambdas.lib.instrumentation import instrumentation
+from lambdas.lib.ratelimit import TokenBucket
+from lambdas.lib.toggl.retry import RetryPolicy
+
+# orjson parses large listings several times faster, it is optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # for making requests
 # backward compatibility with python2
@@ -25,6 +39,124 @@ else:
         pass
 
 
+# decoder and encoder are built once and reused for every request
+_json_decoder = json.JSONDecoder()
+_json_encoder = json.JSONEncoder()
+
+
+def loads(data):
+    '''parse JSON from str or straight from the response bytes'''
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode('utf-8')
+    return _json_decoder.decode(data)
+
+
+def dumps(obj):
+    '''encode obj as JSON bytes'''
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return _json_encoder.encode(obj).encode('utf-8')
+
+
+def decompressor(encoding):
+    '''zlib decompressor for a Content-Encoding, None if the body is not compressed'''
+    if encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        # zlib wrapped deflate, raw deflate streams are handled by DecodedResponse
+        return zlib.decompressobj(zlib.MAX_WBITS)
+    return None
+
+
+def decompress(data, encoding):
+    '''decompress a fully read body according to its Content-Encoding'''
+    d = decompressor(encoding)
+    if d is None:
+        return data
+    try:
+        return d.decompress(data) + d.flush()
+    except zlib.error:
+        if encoding != 'deflate':
+            raise
+        return zlib.decompress(data, -zlib.MAX_WBITS)
+
+
+class DecodedResponse(io.BufferedIOBase):
+    '''
+    file-like view of a response, gzip or deflate encoded bodies are decompressed chunk by chunk while read.
+    raw_bytes counts the bytes on the wire read so far.
+    '''
+
+    def __init__(self, response, chunk_size):
+        self.response = response
+        self.code = response.code
+        self.encoding = response.headers.get('Content-Encoding')
+        self.decompressor = decompressor(self.encoding)
+        self.chunk_size = chunk_size
+        self.pending = b''
+        self.eof = False
+        self.started = False
+        self.raw_bytes = 0
+
+    def readable(self):
+        return True
+
+    def _decompress(self, chunk):
+        if self.decompressor is None:
+            return chunk
+        try:
+            data = self.decompressor.decompress(chunk)
+        except zlib.error:
+            if self.started or self.encoding != 'deflate':
+                raise
+            # some servers send raw deflate without the zlib header
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self.decompressor.decompress(chunk)
+        self.started = True
+        return data
+
+    def _fill(self):
+        '''decompress until some data is pending, False at the end of the stream'''
+        while not self.pending:
+            if self.eof:
+                return False
+            chunk = self.response.read(self.chunk_size)
+            self.raw_bytes += len(chunk)
+            if chunk:
+                self.pending = self._decompress(chunk)
+            else:
+                self.pending = self.decompressor.flush() if self.decompressor else b''
+                self.eof = True
+        return True
+
+    def read1(self, size=-1):
+        if not self._fill():
+            return b''
+        if size is None or size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def read(self, size=-1):
+        parts = []
+        while (size is None or size < 0 or size > 0) and self._fill():
+            data = self.read1(size)
+            parts.append(data)
+            if size is not None and size > 0:
+                size -= len(data)
+        return b''.join(parts)
+
+    def close(self):
+        self.response.close()
+        super().close()
+
+
+# the v8 time entries listing silently returns at most this many entries
+TIME_ENTRIES_LIMIT = 1000
+
+
 # --------------------------------------------
 # Class containing the endpoint URLs for Toggl
 # --------------------------------------------
@@ -39,6 +171,7 @@ class Endpoints():
     START_TIME = "https://api.track.toggl.com/api/v8/time_entries/start"
     TIME_ENTRIES = "https://api.track.toggl.com/api/v8/time_entries"
     CURRENT_RUNNING_TIME = "https://api.track.toggl.com/api/v8/time_entries/current"
+    ME = "https://api.track.toggl.com/api/v8/me"
 
     @staticmethod
     def STOP_TIME(pid):
@@ -54,18 +187,28 @@ class Toggl():
         "Authorization": "",
         "Content-Type": "application/json",
         "Accept": "*/*",
+        "Accept-Encoding": "gzip, deflate",
         "User-Agent": "python/urllib",
     }
 
     # default API user agent value
     user_agent = "TogglPy"
 
+    # transient errors are retried with backoff, see setRetryPolicy
+    retry_policy = RetryPolicy()
+
+    # size of the blocks copied when streaming report exports
+    chunk_size = 64 * 1024
+
+    # TokenBucket every request waits for, see setRateLimit
+    rate_limiter = None
+
     # ------------------------------------------------------------
     # Auxiliary methods
     # ------------------------------------------------------------
 
     def decodeJSON(self, jsonString):
-        return json.JSONDecoder().decode(jsonString)
+        return loads(jsonString)
 
     # ------------------------------------------------------------
     # Methods that modify the headers to control our HTTP requests
@@ -76,53 +219,140 @@ class Toggl():
         authHeader = APIKey + ":" + "api_token"
         authHeader = "Basic " + b64encode(authHeader.encode()).decode('ascii').rstrip()
 
-        # add it into the header
-        self.headers['Authorization'] = authHeader
+        # add it into the headers of this instance, the class template is shared by every Toggl
+        self.headers = dict(self.headers, Authorization=authHeader)
 
     def setAuthCredentials(self, email, password):
         authHeader = '{0}:{1}'.format(email, password)
         authHeader = "Basic " + b64encode(authHeader.encode()).decode('ascii').rstrip()
 
-        # add it into the header
-        self.headers['Authorization'] = authHeader
+        # add it into the headers of this instance, the class template is shared by every Toggl
+        self.headers = dict(self.headers, Authorization=authHeader)
 
     def setUserAgent(self, agent):
         '''set the User-Agent setting, by default it's set to TogglPy'''
         self.user_agent = agent
 
+    def setRetryPolicy(self, policy):
+        '''set the RetryPolicy applied to transient errors, None disables retries'''
+        self.retry_policy = policy
+
+    def setRateLimit(self, rate, burst=1):
+        '''limit the requests per second, the limit is shared by all Toggl instances using the same credentials'''
+        self.rate_limiter = TokenBucket.shared(self.headers['Authorization'], rate, burst)
+
     # -----------------------------------------------------
     # Methods for directly requesting data from an endpoint
     # -----------------------------------------------------
 
+    def send(self, request, recover=None):
+        '''
+        send a request and return (status, body) of the response, transient errors are retried
+        :param recover: called before a POST is sent again, its (status, body) result is returned instead when not None
+        '''
+        def attempt():
+            if self.rate_limiter:
+                # waiting for the client side limit is not latency of the request
+                call.throttle(self.rate_limiter)
+            response = urlopen(request, cafile=cafile)
+            raw = response.read()
+            # bytes on the wire, before decompression
+            call.bytes = len(raw)
+            return response.code, decompress(raw, response.headers.get('Content-Encoding'))
+
+        endpoint = instrumentation.normalize_endpoint(request.full_url)
+        with instrumentation.call('toggl', endpoint, request.get_method()) as call:
+            if self.retry_policy is None:
+                status, body = attempt()
+            else:
+                # a POST is only resent blindly if it never reached the server, unless we can recover its result
+                idempotent = request.get_method() != 'POST' or recover is not None
+                status, body = self.retry_policy.call(
+                    attempt, idempotent=idempotent, before_retry=recover, on_retry=call.retried
+                )
+            call.status = status
+            if call.bytes is None:
+                call.bytes = len(body)
+        return status, body
+
+    def openResponse(self, request, call):
+        '''
+        open a request with retries of transient errors and return it unread as DecodedResponse, the caller closes it.
+        Compressed responses are decompressed while they are read.
+        :param call: CallRecord of the request, receives the retries and the time throttled
+        '''
+        def attempt():
+            if self.rate_limiter:
+                call.throttle(self.rate_limiter)
+            return DecodedResponse(urlopen(request, cafile=cafile), self.chunk_size)
+
+        if self.retry_policy is None:
+            return attempt()
+        return self.retry_policy.call(attempt, on_retry=call.retried)
+
+    def streamRaw(self, endpoint, parameters=None, target=None):
+        '''
+        GET an endpoint and copy the RAW response into target in chunks of chunk_size, so the memory use is constant
+        :param target: filename or a writable binary file object
+        :return: number of bytes written
+        '''
+        if parameters is not None:
+            if 'user_agent' not in parameters:
+                parameters.update({'user_agent': self.user_agent})
+            endpoint = endpoint + "?" + urlencode(parameters)
+        request = Request(endpoint, headers=self.headers)
+        with instrumentation.call('toggl', instrumentation.normalize_endpoint(endpoint), 'GET') as call:
+            response = self.openResponse(request, call)
+            call.status = response.code
+            try:
+                if isinstance(target, str):
+                    with open(target, "wb") as f:
+                        written = self.copyStream(response, f)
+                else:
+                    written = self.copyStream(response, target)
+            finally:
+                call.bytes = response.raw_bytes
+                response.close()
+        return written
+
+    def copyStream(self, source, target):
+        written = 0
+        while True:
+            chunk = source.read(self.chunk_size)
+            if not chunk:
+                return written
+            target.write(chunk)
+            written += len(chunk)
+
     def requestRaw(self, endpoint, parameters=None):
         '''make a request to the toggle api at a certain endpoint and return the RAW page data (usually JSON)'''
         if parameters is None:
-            return urlopen(Request(endpoint, headers=self.headers), cafile=cafile).read()
+            return self.send(Request(endpoint, headers=self.headers))[1]
         else:
             if 'user_agent' not in parameters:
                 parameters.update({'user_agent': self.user_agent})  # add our class-level user agent in there
             # encode all of our data for a get request & modify the URL
             endpoint = endpoint + "?" + urlencode(parameters)
             # make request and read the response
-            return urlopen(Request(endpoint, headers=self.headers), cafile=cafile).read()
+            return self.send(Request(endpoint, headers=self.headers))[1]
 
     def request(self, endpoint, parameters=None):
         '''make a request to the toggle api at a certain endpoint and return the page data as a parsed JSON dict'''
-        return json.loads(self.requestRaw(endpoint, parameters).decode('utf-8'))
+        return loads(self.requestRaw(endpoint, parameters))
 
-    def postRequest(self, endpoint, parameters=None, method='POST'):
-        '''make a POST request to the toggle api at a certain endpoint and return the RAW page data (usually JSON)'''
+    def postRequest(self, endpoint, parameters=None, method='POST', recover=None):
+        '''
+        make a POST request to the toggle api at a certain endpoint and return the RAW page data (usually JSON)
+        as bytes, decodeJSON parses them without decoding to str first
+        '''
         if method == 'DELETE':  # Calls to the API using the DELETE mothod return a HTTP response rather than JSON
-            return urlopen(Request(endpoint, headers=self.headers, method=method), cafile=cafile).code
+            return self.send(Request(endpoint, headers=self.headers, method=method))[0]
         if parameters is None:
-            return urlopen(Request(endpoint, headers=self.headers, method=method), cafile=cafile).read().decode('utf-8')
+            return self.send(Request(endpoint, headers=self.headers, method=method), recover)[1]
         else:
-            data = json.JSONEncoder().encode(parameters)
-            binary_data = data.encode('utf-8')
+            binary_data = dumps(parameters)
             # make request and read the response
-            return urlopen(
-                Request(endpoint, data=binary_data, headers=self.headers, method=method), cafile=cafile
-            ).read().decode('utf-8')
+            return self.send(Request(endpoint, data=binary_data, headers=self.headers, method=method), recover)[1]
 
     # ---------------------------------
     # Methods for managing Time Entries
@@ -206,9 +436,35 @@ class Toggl():
         data['time_entry']['created_with'] = 'NAME'
         data['time_entry']['billable'] = billable
 
-        response = self.postRequest(Endpoints.TIME_ENTRIES, parameters=data)
+        def recover():
+            # the POST may have succeeded with the response lost, never create the entry twice
+            existing = self.findTimeEntry(data['time_entry'])
+            if existing is not None:
+                return 200, dumps({'data': existing})
+
+        response = self.postRequest(Endpoints.TIME_ENTRIES, parameters=data, recover=recover)
         return self.decodeJSON(response)
 
+    @staticmethod
+    def timeEntryKey(entry):
+        '''normalized identity of a time entry: project, start second, duration and description'''
+        start = Toggl.parseTime(entry['start'])
+        return (
+            entry.get('pid'),
+            int(start.timestamp()),
+            int(entry['duration']),
+            (entry.get('description') or '').strip(),
+        )
+
+    def findTimeEntry(self, entry):
+        '''return the existing time entry with the same normalized key as the given one, or None'''
+        key = self.timeEntryKey(entry)
+        start = self.parseTime(entry['start'])
+        for existing in self.getTimeEntries(start - timedelta(seconds=1), start + timedelta(minutes=1)):
+            if self.timeEntryKey(existing) == key:
+                return existing
+        return None
+
     def putTimeEntry(self, parameters):
         if 'id' not in parameters:
             raise Exception("An id must be provided in order to put a time entry")
@@ -216,10 +472,17 @@ class Toggl():
         if type(id) is not int:
             raise Exception("Invalid id %s provided " % (id))
         endpoint = Endpoints.TIME_ENTRIES + "/" + str(id)  # encode all of our data for a put request & modify the URL
-        data = json.JSONEncoder().encode({'time_entry': parameters}).encode('utf-8')
+        data = dumps({'time_entry': parameters})
         request = Request(endpoint, data=data, headers=self.headers, method='PUT')
 
-        return json.loads(urlopen(request).read())
+        return loads(self.send(request)[1])
+
+    def deleteTimeEntry(self, id):
+        """
+        Delete the specified time entry
+        :param id: The id of the time entry to delete
+        """
+        return self.postRequest(Endpoints.TIME_ENTRIES + '/{0}'.format(id), method='DELETE')
 
     def getTimeEntries(self, start_date, end_date):
         endpoint = Endpoints.TIME_ENTRIES
@@ -233,7 +496,59 @@ class Toggl():
         }
         endpoint = endpoint + "?" + urlencode(parameters)
         request = Request(endpoint, headers=self.headers, method='GET')
-        return json.loads(urlopen(request).read())
+        return loads(self.send(request)[1])
+
+    def getTimeEntriesSince(self, since):
+        '''
+        return (server time, time entries changed after since) using the related data of /me.
+        since is a unix timestamp, deleted entries carry server_deleted_at.
+        Toggl only includes time entries of the last 9 days in the related data.
+        '''
+        response = self.request(Endpoints.ME, parameters={'with_related_data': 'true', 'since': int(since)})
+        return response.get('since'), (response.get('data') or {}).get('time_entries') or []
+
+    def iterTimeEntries(self, start_date, end_date, window=timedelta(days=31), workers=4):
+        '''
+        yield the time entries from start_date till end_date (datetimes) in start order.
+        The range is fetched in windows by parallel workers under the rate limit, a window hitting
+        TIME_ENTRIES_LIMIT is split in halves until it fits, entries are deduplicated by id.
+        '''
+        windows = []
+        window_start = start_date
+        while window_start < end_date:
+            window_end = min(window_start + window, end_date)
+            windows.append((window_start, window_end))
+            window_start = window_end
+        if not windows:
+            return
+        pool = ThreadPoolExecutor(max_workers=min(workers, len(windows)))
+        futures = [pool.submit(self.getTimeEntriesWindow, s, e) for s, e in windows]
+        try:
+            seen = set()
+            for future in futures:
+                for entry in future.result():
+                    if entry['id'] in seen:
+                        continue
+                    seen.add(entry['id'])
+                    yield entry
+        finally:
+            # the consumer may stop early, skip the windows nobody waits for
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+    def getTimeEntriesWindow(self, start_date, end_date, min_window=timedelta(hours=1)):
+        '''return the time entries of a window sorted by start, splitting the window while it hits the listing limit'''
+        entries = self.getTimeEntries(start_date, end_date)
+        if len(entries) < TIME_ENTRIES_LIMIT or end_date - start_date <= min_window:
+            return sorted(entries, key=lambda e: self.parseTime(e['start']))
+        middle = start_date + (end_date - start_date) / 2
+        return self.getTimeEntriesWindow(start_date, middle, min_window) + \
+            self.getTimeEntriesWindow(middle, end_date, min_window)
+
+    @staticmethod
+    def parseTime(value):
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
 
     # ----------------------------------
     # Methods for getting workspace data
@@ -398,12 +713,8 @@ class Toggl():
 
     def getWeeklyReportPDF(self, data, filename):
         '''save a weekly report as a PDF'''
-        # get the raw pdf file data
-        filedata = self.requestRaw(Endpoints.REPORT_WEEKLY + ".pdf", parameters=data)
-
-        # write the data to a file
-        with open(filename, "wb") as pdf:
-            pdf.write(filedata)
+        # stream the pdf into the file (filename or binary file object)
+        self.streamRaw(Endpoints.REPORT_WEEKLY + ".pdf", parameters=data, target=filename)
 
     def getDetailedReport(self, data):
         '''return a detailed report for a user'''
@@ -426,24 +737,35 @@ class Toggl():
 
     def getDetailedReportPDF(self, data, filename):
         '''save a detailed report as a pdf'''
-        # get the raw pdf file data
-        filedata = self.requestRaw(Endpoints.REPORT_DETAILED + ".pdf", parameters=data)
-
-        # write the data to a file
-        with open(filename, "wb") as pdf:
-            pdf.write(filedata)
+        # stream the pdf into the file (filename or binary file object)
+        self.streamRaw(Endpoints.REPORT_DETAILED + ".pdf", parameters=data, target=filename)
 
     def getDetailedReportCSV(self, data, filename=None):
-        '''save a detailed report as a csv'''
-        # get the raw pdf file data
-        filedata = self.requestRaw(Endpoints.REPORT_DETAILED + ".csv", parameters=data)
-
+        '''save a detailed report as a csv, streamed into filename (or binary file object) if given, else returned'''
         if filename:
-            # write the data to a file
-            with open(filename, "wb") as pdf:
-                pdf.write(filedata)
+            self.streamRaw(Endpoints.REPORT_DETAILED + ".csv", parameters=data, target=filename)
         else:
-            return filedata
+            return self.requestRaw(Endpoints.REPORT_DETAILED + ".csv", parameters=data)
+
+    def iterDetailedReportCSV(self, data):
+        '''yield the rows of the detailed report csv as dicts, parsed lazily while the response is streamed'''
+        if 'user_agent' not in data:
+            data.update({'user_agent': self.user_agent})
+        endpoint = Endpoints.REPORT_DETAILED + ".csv?" + urlencode(data)
+        # the call lasts until the whole body is streamed, the consumer runs between the rows
+        with instrumentation.call(
+            'toggl', instrumentation.normalize_endpoint(endpoint), 'GET', collect_responses=False
+        ) as call:
+            response = self.openResponse(Request(endpoint, headers=self.headers), call)
+            call.status = response.code
+            try:
+                # utf-8-sig drops the byte order mark in front of the header
+                text = io.TextIOWrapper(response, encoding='utf-8-sig', newline='')
+                for row in csv.DictReader(text):
+                    yield row
+            finally:
+                call.bytes = response.raw_bytes
+                response.close()
 
     def getSummaryReport(self, data):
         '''return a summary report for a user'''
@@ -451,12 +773,8 @@ class Toggl():
 
     def getSummaryReportPDF(self, data, filename):
         '''save a summary report as a pdf'''
-        # get the raw pdf file data
-        filedata = self.requestRaw(Endpoints.REPORT_SUMMARY + ".pdf", parameters=data)
-
-        # write the data to a file
-        with open(filename, "wb") as pdf:
-            pdf.write(filedata)
+        # stream the pdf into the file (filename or binary file object)
+        self.streamRaw(Endpoints.REPORT_SUMMARY + ".pdf", parameters=data, target=filename)
 
     # --------------------------------
     # Methods for creating, updating, and deleting clients
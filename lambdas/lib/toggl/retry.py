@@ -0,0 +1,88 @@
+"""
+Retry policy for Toggl requests: classification of transient errors,
+exponential backoff with full jitter and a total deadline per call.
+"""
+import http.client
+import logging
+import random
+import socket
+import time
+from urllib.error import HTTPError, URLError
+
+
+# statuses worth retrying at all
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+# statuses which guarantee the request was not processed, safe to resend even for a POST
+REJECTED_STATUS = (429, 503)
+
+
+class RetryPolicy:
+    # named in the retry warnings
+    service = 'Toggl'
+
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=20, deadline=60):
+        """
+        :param max_attempts: attempts in total, including the first one
+        :param base_delay: backoff in seconds after the first failure, doubled with every attempt
+        :param max_delay: upper bound of a single backoff
+        :param deadline: total time budget in seconds, no retry is started after it would be exceeded
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    @staticmethod
+    def is_retryable(error, idempotent=True):
+        """
+        Transient errors can be retried. For requests which are not idempotent only the errors
+        proving that the server did not process the request are retryable.
+        """
+        if isinstance(error, HTTPError):
+            return error.code in (RETRYABLE_STATUS if idempotent else REJECTED_STATUS)
+        if isinstance(error, URLError):
+            if idempotent:
+                return True
+            # the connection was never established
+            return isinstance(error.reason, (ConnectionRefusedError, socket.gaierror))
+        if isinstance(error, (socket.timeout, ConnectionError, http.client.HTTPException)):
+            return idempotent
+        return False
+
+    def delay(self, attempt, error=None):
+        """Backoff before the given retry attempt (1 based), honouring Retry-After of a 429"""
+        if isinstance(error, HTTPError) and error.code == 429 and error.headers:
+            retry_after = error.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, func, idempotent=True, before_retry=None, on_retry=None):
+        """
+        Call func until it succeeds, the error is not retryable or the budget is spent.
+        :param before_retry: called before every retry, a result other than None is returned instead of retrying.
+            It should be idempotent, when it fails that counts as one more failed attempt.
+        :param on_retry: called with (attempt, error, delay) for every retry, e.g. for metrics
+        """
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            recovering = bool(attempt and before_retry)
+            try:
+                if recovering:
+                    result = before_retry()
+                    if result is not None:
+                        return result
+                    recovering = False
+                return func()
+            except Exception as error:
+                attempt += 1
+                if attempt >= self.max_attempts or not self.is_retryable(error, idempotent or recovering):
+                    raise
+                delay = self.delay(attempt, error)
+                if time.monotonic() - started + delay > self.deadline:
+                    raise
+                logging.warning("%s request failed (%s), retry %s in %.1fs", self.service, error, attempt, delay)
+                if on_retry:
+                    on_retry(attempt, error, delay)
+                time.sleep(delay)
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import closing, contextmanager
+from datetime import datetime, timezone
+
+from lambdas.lib.toggl.TogglPy import Toggl
+
+
+DEFAULT_DB_PATH = os.path.join(tempfile.gettempdir(), 'toggl_mirror.sqlite3')
+# the delta of /me?since= only includes time entries starting in the last 9 days
+DELTA_DAYS = 9
+
+
+class TimeEntryMirror:
+    """
+    Local SQLite copy of the Toggl time entries of one account, indexed by date, project and id.
+
+    The mirror is kept per calendar month (UTC). A month is downloaded once, afterwards only a delta
+    of the entries changed since the watermark (highest `at` seen) is requested. Toggl only includes
+    entries of the last 9 days in that delta, so months last downloaded more than `max_age` seconds ago
+    are downloaded again, and an exact refresh downloads every month with days older than that.
+    """
+
+    def __init__(self, toggl, path=DEFAULT_DB_PATH, max_age=3600):
+        self.toggl = toggl
+        self.path = path
+        self.max_age = max_age
+        # entries of different accounts never mix
+        self.scope = hashlib.sha256(toggl.headers['Authorization'].encode('utf-8')).hexdigest()[:16]
+        with self.connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS time_entries ('
+                ' scope TEXT NOT NULL,'
+                ' id INTEGER NOT NULL,'
+                ' date TEXT NOT NULL,'
+                ' pid INTEGER,'
+                ' start_ts REAL NOT NULL,'
+                ' at_ts REAL,'
+                ' payload TEXT NOT NULL,'
+                ' PRIMARY KEY (scope, id))'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS time_entries_date ON time_entries (scope, date)')
+            conn.execute('CREATE INDEX IF NOT EXISTS time_entries_pid ON time_entries (scope, pid)')
+            conn.execute('CREATE INDEX IF NOT EXISTS time_entries_start ON time_entries (scope, start_ts)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS mirrored_months ('
+                ' scope TEXT NOT NULL,'
+                ' month TEXT NOT NULL,'
+                ' fetched_at REAL NOT NULL,'
+                ' PRIMARY KEY (scope, month))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS watermarks ('
+                ' scope TEXT PRIMARY KEY,'
+                ' watermark REAL NOT NULL)'
+            )
+
+    @classmethod
+    def from_env(cls, toggl):
+        """Mirror configured by TOGGL_MIRROR_DB (an empty value disables it) and TOGGL_MIRROR_MAX_AGE"""
+        path = os.environ.get('TOGGL_MIRROR_DB', DEFAULT_DB_PATH)
+        if not path:
+            return None
+        return cls(toggl, path, max_age=float(os.environ.get('TOGGL_MIRROR_MAX_AGE', 3600)))
+
+    @contextmanager
+    def connect(self):
+        """Connection committed on success and closed afterwards"""
+        with closing(sqlite3.connect(self.path, timeout=30)) as conn, conn:
+            yield conn
+
+    @staticmethod
+    def timestamp(value):
+        return Toggl.parseTime(value).timestamp() if value else None
+
+    @staticmethod
+    def months(start, end):
+        """(key, first moment, first moment of next month) of the UTC months overlapping start till end (excluded)"""
+        month = datetime(start.year, start.month, 1, tzinfo=timezone.utc)
+        result = []
+        while month < end:
+            next_month = datetime(month.year + month.month // 12, month.month % 12 + 1, 1, tzinfo=timezone.utc)
+            result.append((month.strftime('%Y-%m'), month, next_month))
+            month = next_month
+        return result
+
+    def row(self, entry):
+        return (
+            self.scope,
+            entry['id'],
+            Toggl.parseTime(entry['start']).date().isoformat(),
+            entry.get('pid'),
+            self.timestamp(entry['start']),
+            self.timestamp(entry.get('at')),
+            json.dumps(entry),
+        )
+
+    def upsert(self, entries, conn=None):
+        """
+        Store created or changed entries, entries with server_deleted_at are removed.
+        The watermark is left alone, own writes must not hide changes made by others meanwhile.
+        """
+        entries = list(entries)
+        deleted = [(self.scope, e['id']) for e in entries if e.get('server_deleted_at')]
+        alive = [self.row(e) for e in entries if not e.get('server_deleted_at')]
+        if conn is None:
+            with self.connect() as conn:
+                return self.upsert(entries, conn)
+        conn.executemany('DELETE FROM time_entries WHERE scope = ? AND id = ?', deleted)
+        conn.executemany('INSERT OR REPLACE INTO time_entries VALUES (?, ?, ?, ?, ?, ?, ?)', alive)
+
+    def delete(self, entry_ids):
+        with self.connect() as conn:
+            conn.executemany(
+                'DELETE FROM time_entries WHERE scope = ? AND id = ?', [(self.scope, i) for i in entry_ids]
+            )
+
+    def raise_watermark(self, conn, watermark):
+        if watermark:
+            # no UPSERT, the sqlite of older Lambda runtimes does not support it
+            conn.execute('INSERT OR IGNORE INTO watermarks VALUES (?, ?)', (self.scope, watermark))
+            conn.execute(
+                'UPDATE watermarks SET watermark = ? WHERE scope = ? AND watermark < ?',
+                (watermark, self.scope, watermark),
+            )
+
+    def refresh(self, start, end, exact=False):
+        """
+        Bring the months overlapping start till end (aware datetimes) up to date.
+        :param exact: download again the months of the range with days the delta does not cover,
+            changes made to them since their download would be missed otherwise. Needed by plans that write.
+        """
+        now = time.time()
+        months = self.months(start, end)
+        with self.connect() as conn:
+            fetched = dict(conn.execute(
+                'SELECT month, fetched_at FROM mirrored_months WHERE scope = ?', (self.scope,)
+            ).fetchall())
+            row = conn.execute('SELECT watermark FROM watermarks WHERE scope = ?', (self.scope,)).fetchone()
+        watermark = row[0] if row else None
+
+        uncovered = now - DELTA_DAYS * 86400
+        stale = [
+            m for m in months
+            if now - fetched.get(m[0], 0) > self.max_age or exact and max(start, m[1]).timestamp() < uncovered
+        ]
+        if watermark is None:
+            stale = months
+        elif len(stale) < len(months):
+            server_time, changed = self.toggl.getTimeEntriesSince(watermark)
+            logging.info("Toggl mirror delta: %s changed entries", len(changed))
+            with self.connect() as conn:
+                self.upsert(changed, conn)
+                self.raise_watermark(conn, server_time)
+
+        for key, month_start, month_end in stale:
+            entries = list(self.toggl.iterTimeEntries(month_start, month_end))
+            with self.connect() as conn:
+                conn.execute(
+                    'DELETE FROM time_entries WHERE scope = ? AND start_ts >= ? AND start_ts < ?',
+                    (self.scope, month_start.timestamp(), month_end.timestamp()),
+                )
+                self.upsert(entries, conn)
+                if watermark is None:
+                    # start the deltas at the latest change seen, or at the request time minus some clock skew
+                    latest = max((self.timestamp(e.get('at')) or 0 for e in entries), default=0)
+                    self.raise_watermark(conn, latest or now - 60)
+                conn.execute('INSERT OR REPLACE INTO mirrored_months VALUES (?, ?, ?)', (self.scope, key, now))
+        if stale:
+            logging.info("Toggl mirror downloaded months: %s", ', '.join(m[0] for m in stale))
+
+    def entries(self, start, end, pid=None):
+        """Time entries starting from start till end (aware datetimes) ordered by start"""
+        query = 'SELECT payload FROM time_entries WHERE scope = ? AND start_ts >= ? AND start_ts <= ?'
+        params = [self.scope, start.timestamp(), end.timestamp()]
+        if pid is not None:
+            query += ' AND pid = ?'
+            params.append(pid)
+        with self.connect() as conn:
+            rows = conn.execute(query + ' ORDER BY start_ts, id', params).fetchall()
+        return [json.loads(payload) for payload, in rows]
@@ -1,20 +1,116 @@
 import logging
 import os
-from datetime import datetime, timezone
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.error import HTTPError
 from lambdas.lib.toggl.TogglPy import Toggl
+from lambdas.lib.toggl_mirror import TimeEntryMirror
 
 
 API_KEY = os.environ.get('TOGGL_API_KEY')
+# Toggl allows about one request per second per API token, with short bursts
+RATE_LIMIT = float(os.environ.get('TOGGL_RATE_LIMIT', 1))
+RATE_BURST = int(os.environ.get('TOGGL_RATE_BURST', 5))
+
+
+class SyncPlan:
+    """
+    Changes bringing the Toggl entries of some days in line with the timesheet rows of those days.
+
+    Rows and entries are compared per date and project. Identical ones are left alone, the remaining
+    pairs of the same date and project (changed duration and/or comment) become updates. Rows left
+    over are created, Toggl entries left over are deleted.
+    """
+
+    def __init__(self):
+        self.unchanged = []  # toggl entries
+        self.creates = []  # sheet entries
+        self.updates = []  # (toggl entry, sheet entry)
+        self.deletes = []  # toggl entries
+
+    @staticmethod
+    def as_sheet_entry(row):
+        """Annotated Toggl entry in the format of the timesheet rows"""
+        return {
+            'duration': int(row['duration'] / 60),
+            'date': datetime.fromisoformat(row['start']).date().isoformat(),
+            'comment': row['description'],
+            'project': row['project_name'],
+        }
+
+    @classmethod
+    def build(cls, sheet_entries, toggl_entries):
+        plan = cls()
+        groups = defaultdict(lambda: ([], []))
+        for entry in sheet_entries:
+            groups[(entry['date'], entry.get('project'))][0].append(entry)
+        for row in toggl_entries:
+            entry = cls.as_sheet_entry(row)
+            groups[(entry['date'], entry['project'])][1].append(row)
+        for key in sorted(groups, key=str):
+            sheet, toggl = groups[key]
+            toggl = list(toggl)
+            missing = []
+            for entry in sheet:
+                match = next((row for row in toggl if cls.as_sheet_entry(row) == entry), None)
+                if match is None:
+                    missing.append(entry)
+                else:
+                    toggl.remove(match)
+                    plan.unchanged.append(match)
+            # near-duplicates: keep the comment if possible, then the duration, then pair in order
+            for same in ('comment', 'duration', None):
+                for entry in list(missing):
+                    match = next(
+                        (row for row in toggl if same is None or cls.as_sheet_entry(row)[same] == entry[same]), None
+                    )
+                    if match is not None:
+                        toggl.remove(match)
+                        missing.remove(entry)
+                        plan.updates.append((match, entry))
+            plan.creates.extend(missing)
+            plan.deletes.extend(toggl)
+        return plan
+
+    def __bool__(self):
+        return bool(self.creates or self.updates or self.deletes)
+
+    def format(self):
+        """Reviewable list of the planned changes"""
+        lines = ['%d unchanged, %d to create, %d to update, %d to delete' % (
+            len(self.unchanged), len(self.creates), len(self.updates), len(self.deletes))]
+        for entry in self.creates:
+            lines.append('create  %s %-20s %4d min  %s' % (
+                entry['date'], entry['project'], entry['duration'], entry['comment']))
+        for row, entry in self.updates:
+            old = self.as_sheet_entry(row)
+            lines.append('update  %s %-20s %4d -> %4d min  %s -> %s  (id %s)' % (
+                entry['date'], entry['project'], old['duration'], entry['duration'], old['comment'],
+                entry['comment'], row['id']))
+        for row in self.deletes:
+            old = self.as_sheet_entry(row)
+            lines.append('delete  %s %-20s %4d min  %s  (id %s)' % (
+                old['date'], old['project'], old['duration'], old['comment'], row['id']))
+        return '\n'.join(lines)
 
 
 class TogglWrapper:
-    def __init__(self, client_names=None):
-        assert API_KEY, "TOGGL_API_KEY env variable is not set"
+    def __init__(self, client_names=None, use_mirror=True, api_key=None):
+        """
+        :param use_mirror: read time entries through the local TimeEntryMirror (see TOGGL_MIRROR_DB)
+        :param api_key: Toggl API token of the account to sync, TOGGL_API_KEY by default
+        """
+        api_key = api_key or API_KEY
+        assert api_key, "TOGGL_API_KEY env variable is not set"
         self.toggl = Toggl()
-        self.toggl.setAPIKey(API_KEY)
+        self.toggl.setAPIKey(api_key)
+        self.toggl.setRateLimit(RATE_LIMIT, RATE_BURST)
+        self.mirror = TimeEntryMirror.from_env(self.toggl) if use_mirror else None
         self.clients = {}
         self.projects = {}
         self.project_ids = {}
+        self.project_clients = {}
         self.client_names = None
         if client_names:
             assert isinstance(client_names, list), "client_names argument should be a list of string client names"
@@ -35,45 +131,134 @@ class TogglWrapper:
             for project in projects:
                 self.projects[project['name'].lower()] = project['id']
                 self.project_ids[project['id']] = project['name'].lower()
+                self.project_clients[project['id']] = client_name
+
+    def fetch_time_entries(self, start, end, exact=False):
+        """
+        Time entries from start till end as returned by Toggl, read through the mirror when there is one.
+        :param exact: the entries are used to plan writes, see TimeEntryMirror.refresh
+        """
+        if self.mirror:
+            self.mirror.refresh(start, end, exact=exact)
+            return self.mirror.entries(start, end)
+        return list(self.toggl.iterTimeEntries(start, end))
 
-    def get_annotated_time_entries(self, start, end):
+    def annotate(self, entries):
+        """Add project and client names to fetched time entries"""
         if not self.project_ids:
             self.load_projects()
-        entries = self.toggl.getTimeEntries(start, end)
         for entry in entries:
             entry['project_name'] = self.project_ids[entry['pid']]
+            entry['client_name'] = self.project_clients[entry['pid']]
         return entries
 
-    def sync_to_toggl(self, sheet_entries, start, end):
+    def get_annotated_time_entries(self, start, end, exact=False):
+        return self.annotate(self.fetch_time_entries(start, end, exact))
+
+    @staticmethod
+    def day_range(start, end):
+        """UTC datetimes from the beginning of start till the end of end"""
         dt_start = datetime.combine(start, datetime.min.time()).replace(tzinfo=timezone.utc)
-        dt_end = datetime.combine(end, datetime.min.time()).replace(tzinfo=timezone.utc)
-        toggl_entries = self.get_annotated_time_entries(dt_start, dt_end)
-        existing_entries = [
-            {
-                'duration': int(row['duration'] / 60),
-                'date': datetime.fromisoformat(row['start']).date().isoformat(),
-                'comment': row['description'],
-                'project': row['project_name'],
-            }
-            for row
-            in toggl_entries
-        ]
-        # check items in toggle missing from google sheet
-        for toggl_entry in existing_entries:
-            if toggl_entry not in sheet_entries:
-                logging.error('Entry exists in Toggl, but is missing from Google Timesheet: %s', toggl_entry)
-                raise ValueError("Toggl has data missing in google sheets")
-        # check for items in google sheet missing from toggl and add it
-        for entry in sheet_entries:
+        dt_end = datetime.combine(end, datetime.min.time()).replace(tzinfo=timezone.utc) + timedelta(days=1)
+        return dt_start, dt_end
+
+    def sync_to_toggl(self, sheet_entries, start, end, dates=None, toggl_entries=None, reconcile=False,
+                      dry_run=False):
+        """
+        Create entries missing in Toggl for the range from start till end (both days included).
+        :param dates: optional iso dates to restrict the diff to, other days of the range are ignored
+        :param toggl_entries: annotated Toggl entries covering the range when they are fetched already,
+            entries outside of the range have to be excluded with dates. Read through the mirror,
+            they have to be fetched with exact=True
+        :param reconcile: update and delete Toggl entries differing from the sheet instead of failing
+        :param dry_run: only log the plan of changes, nothing is written
+        :return: {(date, project): [toggl entry ids]} of the synced entries, None for a dry run
+        """
+        if toggl_entries is None:
+            toggl_entries = self.get_annotated_time_entries(*self.day_range(start, end), exact=True)
+        elif not self.projects:
+            self.load_projects()
+        if dates is not None:
+            dates = set(dates)
+            sheet_entries = [entry for entry in sheet_entries if entry['date'] in dates]
+            toggl_entries = [
+                row for row in toggl_entries if datetime.fromisoformat(row['start']).date().isoformat() in dates
+            ]
+        plan = SyncPlan.build(sheet_entries, toggl_entries)
+        if not reconcile and (plan.updates or plan.deletes):
+            # check items in toggle missing from google sheet
+            for row in [row for row, _ in plan.updates] + plan.deletes:
+                logging.error(
+                    'Entry exists in Toggl, but is missing from Google Timesheet: %s', SyncPlan.as_sheet_entry(row)
+                )
+            raise ValueError("Toggl has data missing in google sheets")
+        logging.info("Toggl sync plan:\n%s", plan.format())
+        if dry_run:
+            return None
+        return self.apply_plan(plan)
+
+    def apply_plan(self, plan, workers=4):
+        """
+        Run all changes of the plan at the same time, paced by the rate limit of the token.
+        Every change is attempted, failures are raised together at the end.
+        :return: {(date, project): [toggl entry ids]} of the entries matching the sheet afterwards
+        """
+        written = []
+        deleted = []
+
+        def create(entry):
             assert entry.get('project'), 'project should be set in order to sync with Toggl'
-            if entry not in existing_entries:
-                print("Will create: %s" % entry)
-                dt = datetime.fromisoformat(entry['date'])
-                start_hour = 10
-                res = self.toggl.createTimeEntry(description=entry['comment'],
-                                                 minuteduration=entry['duration'],
-                                                 projectid=self.projects[entry['project']],
-                                                 month=dt.month, day=dt.day, hour=start_hour)
+            dt = datetime.fromisoformat(entry['date'])
+            start_hour = 10
+            return self.toggl.createTimeEntry(description=entry['comment'],
+                                              minuteduration=entry['duration'],
+                                              projectid=self.projects[entry['project']],
+                                              year=dt.year, month=dt.month, day=dt.day, hour=start_hour)['data']
+
+        def update(row, entry):
+            return self.toggl.putTimeEntry({
+                'id': row['id'], 'duration': entry['duration'] * 60, 'description': entry['comment'],
+            })['data']
+
+        def delete(row):
+            try:
+                self.toggl.deleteTimeEntry(row['id'])
+            except HTTPError as error:
+                # a DELETE is resent when its response is lost, the entry is gone already then
+                if error.code != 404:
+                    raise
+                logging.info("Toggl entry %s was deleted already", row['id'])
+            deleted.append(row['id'])
+            return None
+
+        entry_ids = {}
+        for row in plan.unchanged:
+            entry = SyncPlan.as_sheet_entry(row)
+            entry_ids.setdefault((entry['date'], entry['project']), []).append(row['id'])
+        changes = (
+            [(entry, create, (entry,)) for entry in plan.creates]
+            + [(entry, update, (row, entry)) for row, entry in plan.updates]
+            + [(SyncPlan.as_sheet_entry(row), delete, (row,)) for row in plan.deletes]
+        )
+        failures = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(entry, executor.submit(func, *args)) for entry, func, args in changes]
+            for entry, future in futures:
+                try:
+                    result = future.result()
+                except Exception as error:
+                    logging.error("Toggl change of %s failed: %s", entry, error)
+                    failures.append(entry)
+                    continue
+                if result is not None:
+                    written.append(result)
+                    entry_ids.setdefault((entry['date'], entry['project']), []).append(result['id'])
+        if self.mirror:
+            self.mirror.upsert(written)
+            self.mirror.delete(deleted)
+        if failures:
+            raise ValueError(f"{len(failures)} of {len(changes)} Toggl changes failed")
+        return entry_ids
 
     def track(comment, date, duration, start_hour=9, project=None):
         toggl = Toggl()
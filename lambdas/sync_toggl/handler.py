@@ -3,29 +3,138 @@
 import logging
 
 import argparse
+import json
 import sys
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.relativedelta import relativedelta
 from datetime import datetime, date, timedelta
 
 root = os.path.abspath("")
 sys.path.append(root)
 
-from lambdas.lib.google_sheets import GoogleDailyTimeSheets
+from lambdas.lib.db import load_employees
+from lambdas.lib.google_sheets import GoogleDailyTimeSheets, GoogleSheets
+from lambdas.lib.instrumentation import instrumentation
+from lambdas.lib.pipeline import Pipeline
+from lambdas.lib.sync_state import SyncStateLedger
 from lambdas.lib.toggl_wrapper import TogglWrapper
 
 
 logging.basicConfig(level=logging.INFO)
 
+# employees synced at the same time by sync_team
+BATCH_WORKERS = int(os.environ.get('SYNC_BATCH_WORKERS', 4))
+# fetch the Toggl projects and time entries at the same time, SYNC_PIPELINE=0 fetches them one after the other
+PIPELINE = os.environ.get('SYNC_PIPELINE', '1') != '0'
 
-def sync_hours(start, end):
-    spreadsheet = os.environ.get("SPREADSHEET_ID")
-    logging.info(f"Syncing ours for from {start} till {end}")
+
+def sync_hours(start, end, full=False, profile=False, spreadsheet=None, api_key=None, reconcile=False, dry_run=False):
+    """
+    Sync the range and log where the time was spent.
+    Set METRICS_FORMAT=emf to emit the summary as CloudWatch metrics,
+    SYNC_PROFILE=1 (or profile=True) to profile and trace this invocation.
+    :param spreadsheet: timesheet to sync, SPREADSHEET_ID by default
+    :param api_key: Toggl API token to sync to, TOGGL_API_KEY by default
+    :param reconcile: update and delete Toggl entries differing from the timesheet instead of failing
+    :param dry_run: only log the planned Toggl changes
+    """
+    instrumentation.metrics.reset()
+    GoogleSheets.start_run()
+    with instrumentation.profile(enabled=profile or bool(os.environ.get('SYNC_PROFILE'))):
+        try:
+            sync_changed_days(
+                start, end, full=full, spreadsheet=spreadsheet, api_key=api_key, reconcile=reconcile, dry_run=dry_run
+            )
+        finally:
+            report_metrics()
+
+
+def sync_team(start, end, full=False, profile=False, workers=BATCH_WORKERS, reconcile=False, dry_run=False):
+    """
+    Sync the timesheets of all employees of the employees database, `workers` of them at the same time.
+    A failing employee does not stop the others, the run ends with a report of every employee.
+    Each Toggl token keeps its own rate limit, the metrics are collected once for the whole team.
+    """
+    employees = load_employees() or []
+    instrumentation.metrics.reset()
+    GoogleSheets.start_run()
+    with instrumentation.profile(enabled=profile or bool(os.environ.get('SYNC_PROFILE'))):
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(sync_employee, employee, start, end, full, reconcile, dry_run)
+                    for employee in employees
+                ]
+                report = [future.result() for future in futures]
+        finally:
+            report_metrics()
+    report_team(report)
+    return report
+
+
+def employee_sync_config(employee):
+    """
+    (spreadsheet id, Toggl API token) of an employee, None for employees without a timesheet.
+    Tokens are not kept in the database, `toggl_token_env` names the environment variable holding it.
+    """
+    spreadsheet = employee.get('timesheet_id')
+    if not spreadsheet:
+        return None
+    token_env = employee.get('toggl_token_env')
+    api_key = os.environ.get(token_env) if token_env else None
+    if not api_key:
+        raise ValueError(f"Toggl token of {employee.get('nickname')} is not set, expected in {token_env}")
+    return spreadsheet, api_key
+
+
+def sync_employee(employee, start, end, full=False, reconcile=False, dry_run=False):
+    """Sync one employee of sync_team, errors are logged and reported instead of raised"""
+    result = {'employee': employee.get('nickname'), 'status': 'ok', 'days': 0, 'seconds': 0.0, 'error': None}
+    started = time.perf_counter()
+    try:
+        config = employee_sync_config(employee)
+        if config is None:
+            result['status'] = 'skipped'
+        else:
+            spreadsheet, api_key = config
+            result['days'] = sync_changed_days(
+                start, end, full=full, spreadsheet=spreadsheet, api_key=api_key, reconcile=reconcile, dry_run=dry_run
+            )
+    except Exception as error:
+        logging.exception("Sync of %s failed", result['employee'])
+        result['status'] = 'failed'
+        result['error'] = f"{type(error).__name__}: {error}"
+    result['seconds'] = round(time.perf_counter() - started, 1)
+    return result
+
+
+def report_team(report):
+    lines = ['%-20s %-8s %5s %8s  %s' % ('employee', 'status', 'days', 'seconds', 'error')]
+    for row in report:
+        lines.append('%-20s %-8s %5d %8.1f  %s' % (
+            row['employee'], row['status'], row['days'], row['seconds'], row['error'] or ''))
+    failed = [row['employee'] for row in report if row['status'] == 'failed']
+    logging.info("Team sync:\n%s", '\n'.join(lines))
+    if failed:
+        logging.error("Team sync failed for %s of %s employees: %s", len(failed), len(report), ', '.join(failed))
+
+
+def report_metrics():
+    logging.info("Sync calls:\n%s", instrumentation.metrics.format_summary())
+    if os.environ.get('METRICS_FORMAT') == 'emf':
+        # EMF documents are picked up from stdout of the Lambda
+        print(instrumentation.metrics.to_emf())
+
+
+def read_timesheet(spreadsheet, start, end):
+    """Timesheet rows of the range in the format of TogglWrapper.sync_to_toggl"""
     tab_name = start.strftime('%b %y')
     timesheet = GoogleDailyTimeSheets(doc=spreadsheet, sheet=tab_name)
     rows = timesheet.get_days_in_range(start, end)
     # convert to toggl format
-    toggl_format_rows = [
+    return [
         {
             'duration': int(row['duration_minutes']),
             'date': row['date_dt'].date().isoformat(),
@@ -35,8 +144,55 @@ def sync_hours(start, end):
         for row
         in rows
     ]
-    toggl = TogglWrapper(client_names=['Development', 'Clients'])
-    toggl.sync_to_toggl(toggl_format_rows, start, end)
+
+
+def fetch_toggl(stages, toggl, start, end):
+    """Submit the Toggl stages of a sync: the projects and the time entries from start till end"""
+    stages.submit('toggl_metadata', toggl.load_projects)
+    # the entries plan writes, the mirror must not miss changes to older days
+    stages.submit('toggl_entries', toggl.fetch_time_entries, *toggl.day_range(start, end), exact=True)
+
+
+def sync_changed_days(start, end, full=False, spreadsheet=None, api_key=None, pipeline=PIPELINE, reconcile=False,
+                      dry_run=False):
+    """
+    Sync the days of the range changed since the last sync, return the number of days synced.
+    Toggl is only asked once the timesheet has changed days, for a full sync it is fetched while the
+    timesheet is read. With pipeline the Toggl projects and time entries are fetched at the same time.
+    """
+    spreadsheet = spreadsheet or os.environ.get("SPREADSHEET_ID")
+    logging.info(f"Syncing ours for from {start} till {end}")
+    toggl = TogglWrapper(client_names=['Development', 'Clients'], api_key=api_key)
+    with Pipeline(concurrent=pipeline) as stages:
+        stages.submit('sheet', read_timesheet, spreadsheet, start, end)
+        if full:
+            fetch_toggl(stages, toggl, start, end)
+        try:
+            toggl_format_rows = stages.result('sheet')
+            # only days changed since the last successful sync need a Toggl diff
+            ledger = SyncStateLedger.from_env(scope=spreadsheet)
+            if full:
+                changed = list(ledger.date_range(start, end))
+            else:
+                changed = ledger.changed_dates(toggl_format_rows, start, end)
+                if not changed:
+                    logging.info("Timesheet unchanged since last sync, nothing to do")
+                    return 0
+                fetch_toggl(stages, toggl, datetime.fromisoformat(changed[0]), datetime.fromisoformat(changed[-1]))
+            logging.info(f"Syncing {len(changed)} changed days")
+            stages.result('toggl_metadata')
+            toggl_entries = toggl.annotate(stages.result('toggl_entries'))
+            entry_ids = stages.run(
+                'diff', toggl.sync_to_toggl, toggl_format_rows, datetime.fromisoformat(changed[0]),
+                datetime.fromisoformat(changed[-1]), dates=changed, toggl_entries=toggl_entries,
+                reconcile=reconcile, dry_run=dry_run,
+            )
+            if dry_run:
+                return 0
+            stages.run('ledger', ledger.record, toggl_format_rows, changed, entry_ids)
+            return len(changed)
+        finally:
+            stages.log_timings()
 
 
 def parse_time_range(args):
@@ -63,6 +219,80 @@ def parse_time_range(args):
     return start, end
 
 
+def split_range(start, end, unit='month'):
+    """Split the range into consecutive (start, end) jobs of one calendar month or ISO week, end included"""
+    assert unit in ('month', 'week'), "Range can be split by month or week"
+    jobs = []
+    job_start = start
+    while job_start <= end:
+        if unit == 'month':
+            next_start = job_start.replace(day=1) + relativedelta(months=1)
+        else:
+            next_start = job_start - timedelta(days=job_start.weekday()) + timedelta(weeks=1)
+        job_end = min(next_start - timedelta(days=1), end)
+        jobs.append((job_start, job_end))
+        job_start = next_start
+    return jobs
+
+
+def bad_request(error):
+    return {'statusCode': 400, 'body': json.dumps({'error': error})}
+
+
+def dispatch(event, context):
+    """
+    Split a requested range into per-month (or per-week) jobs and put them on the work queue.
+    Expects start and end as day.month.year and optional split (month/week),
+    either as query string parameters or as JSON body of the API Gateway request.
+    """
+    params = dict(event.get('queryStringParameters') or {})
+    if event.get('body'):
+        try:
+            body = json.loads(event['body'])
+        except ValueError:
+            return bad_request('Body should be a JSON object')
+        if not isinstance(body, dict):
+            return bad_request('Body should be a JSON object')
+        params.update(body)
+    try:
+        start = datetime.strptime(params['start'], '%d.%m.%Y')
+        end = datetime.strptime(params['end'], '%d.%m.%Y')
+    except (KeyError, TypeError, ValueError):
+        return bad_request('start and end should be given as day.month.year')
+    if start > end:
+        return bad_request('Start date should be before end date')
+    split = params.get('split', 'month')
+    if split not in ('month', 'week'):
+        return bad_request('split should be month or week')
+    jobs = split_range(start, end, split)
+    entries = [
+        {
+            'Id': str(i),
+            'MessageBody': json.dumps({'start': job_start.date().isoformat(), 'end': job_end.date().isoformat()}),
+        }
+        for i, (job_start, job_end)
+        in enumerate(jobs)
+    ]
+    import boto3
+
+    queue_url = os.environ.get('SYNC_QUEUE_URL')
+    sqs = boto3.client('sqs')
+    # SQS accepts at most 10 messages per batch
+    for i in range(0, len(entries), 10):
+        response = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries[i:i + 10])
+        if response.get('Failed'):
+            raise RuntimeError(f"Could not enqueue sync jobs: {response['Failed']}")
+    logging.info(f"Dispatched {len(jobs)} sync jobs from {start} till {end}")
+    return {'statusCode': 202, 'body': json.dumps({'jobs': len(jobs)})}
+
+
+def work(event, context):
+    """Run the sync jobs received from the work queue. A failing job is retried and ends up in the dead-letter queue."""
+    for record in event['Records']:
+        job = json.loads(record['body'])
+        sync_hours(datetime.fromisoformat(job['start']), datetime.fromisoformat(job['end']))
+
+
 def handle(event, context):
     """
     This code used to be run from command line, therefore we have ArgumentParser.
@@ -78,6 +308,12 @@ def handle(event, context):
     parser.add_argument('-m', '--month', help='sync one month', action='store_true')
     parser.add_argument('-s', '--start', help='first date of range, day.month.year (15.01.2021)', type=str)
     parser.add_argument('-e', '--end', help='last date of range, day.month.year (25.02.2021)', type=str)
+    parser.add_argument('-f', '--full', help='ignore sync state and diff every day of the range', action='store_true')
+    parser.add_argument('--profile', help='profile and trace all API calls of this run', action='store_true')
+    parser.add_argument('-t', '--team', help='sync every employee of the employees database', action='store_true')
+    parser.add_argument('-r', '--reconcile', help='update and delete Toggl entries not matching the timesheet',
+                        action='store_true')
+    parser.add_argument('-n', '--dry-run', help='only log the planned Toggl changes', action='store_true')
     parser.add_argument('--help', action='help', help='show this help message and exit')
 
     args = parser.parse_args()
@@ -88,4 +324,7 @@ def handle(event, context):
     assert (args.start and args.end) or args.week or args.month, "Time range should be provided"
     start, end = parse_time_range(args)
     assert start < end, "Start date should be before end date"
-    sync_hours(start, end)
+    if args.team:
+        sync_team(start, end, full=args.full, profile=args.profile, reconcile=args.reconcile, dry_run=args.dry_run)
+    else:
+        sync_hours(start, end, full=args.full, profile=args.profile, reconcile=args.reconcile, dry_run=args.dry_run)
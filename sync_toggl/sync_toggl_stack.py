@@ -1,5 +1,6 @@
 from constructs import Construct
 from aws_cdk import (
+    BundlingOptions,
     Duration,
     Stack,
     aws_iam as iam,
@@ -7,23 +8,171 @@ from aws_cdk import (
     aws_sns as sns,
     aws_sns_subscriptions as subs,
     aws_lambda as _lambda,
+    aws_lambda_event_sources as event_sources,
+    aws_cloudwatch as cloudwatch,
+    aws_cloudwatch_actions as cw_actions,
     aws_apigateway as apigw
 )
 
 
+# one job syncs at most a month, that fits comfortably into five minutes
+WORKER_TIMEOUT = Duration.seconds(300)
+# the SQS poller invokes the workers beyond their reserved concurrency, every throttled invocation puts
+# its job back and counts as a receive: AWS recommends a visibility timeout of six function timeouts
+# and at least five receives, so months that never ran are not dead-lettered during long backfills
+JOBS_VISIBILITY_TIMEOUT = Duration.seconds(6 * WORKER_TIMEOUT.to_seconds())
+JOBS_MAX_RECEIVE_COUNT = 5
+RUNTIME = _lambda.Runtime.PYTHON_3_12
+# wheels of the layer are picked for the Python of the runtime, e.g. 3.12 of python3.12
+PYTHON_VERSION = RUNTIME.name[len('python'):]
+# per process defaults of the rate limits, see lambdas/lib/toggl_wrapper.py and lambdas/lib/sheets_scheduler.py
+TOGGL_RATE_LIMIT = 1
+TOGGL_RATE_BURST = 5
+SHEETS_PER_MINUTE = 60
+SHEETS_BURST = 5
+# wheels are picked for the target architecture, so the layer can be built on any machine
+PIP_PLATFORMS = {
+    _lambda.Architecture.X86_64.name: 'manylinux2014_x86_64',
+    _lambda.Architecture.ARM_64.name: 'manylinux2014_aarch64',
+}
+# packages of the build tools and of the Lambda runtime itself, never imported by the functions
+STRIPPED_PACKAGES = (
+    'pip', 'setuptools', 'wheel', 'pkg_resources', '_distutils_hack', 'boto3', 'botocore', 's3transfer',
+)
+
+
+def worker_rate_limits(worker_concurrency):
+    """Environment splitting the Toggl and Google Sheets limits between the workers running at the same time"""
+    return {
+        'TOGGL_RATE_LIMIT': str(TOGGL_RATE_LIMIT / worker_concurrency),
+        'TOGGL_RATE_BURST': str(max(1, TOGGL_RATE_BURST // worker_concurrency)),
+        'SHEETS_READS_PER_MINUTE': str(max(2, SHEETS_PER_MINUTE // worker_concurrency)),
+        'SHEETS_WRITES_PER_MINUTE': str(max(2, SHEETS_PER_MINUTE // worker_concurrency)),
+        'SHEETS_BURST': str(max(1, SHEETS_BURST // worker_concurrency)),
+    }
+
+
+def precompile(output):
+    """
+    Shell step writing the .pyc files at build time, /opt and /var/task are read-only at runtime.
+    The asset zip resets every modification time to 1980, so the .pyc files are not validated
+    against the sources, otherwise Python would ignore them and compile again on every cold start.
+    """
+    return f'python -m compileall -q -j 0 --invalidation-mode unchecked-hash {output}'
+
+
+def layer_command(architecture):
+    """Build of the layer: third-party dependencies and the shared lambdas/lib under python/"""
+    output = '/asset-output/python'
+    return ' && '.join([
+        f'pip install -r requirements.txt -t {output} --no-compile --no-cache-dir --only-binary=:all: '
+        f'--platform {PIP_PLATFORMS[architecture.name]} --implementation cp --python-version {PYTHON_VERSION}',
+        f'cd {output}',
+        'rm -rf bin ' + ' '.join(f'{name} {name}-*.dist-info' for name in STRIPPED_PACKAGES),
+        'find . -type d \\( -name tests -o -name __pycache__ \\) -prune -exec rm -rf {} +',
+        f'mkdir -p {output}/lambdas',
+        f'cp -r /asset-input/lib /asset-input/database {output}/lambdas/',
+        precompile(output),
+    ])
+
+
 class SyncTogglStack(Stack):
 
-    def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str, worker_concurrency: int = 2, memory_size: int = 256,
+                 architecture: _lambda.Architecture = _lambda.Architecture.ARM_64, **kwargs) -> None:
+        """
+        :param worker_concurrency: reserved concurrency of the queue workers, every worker gets
+            its share of the Toggl (1 request per second per token) and Google Sheets rate limits
+        :param memory_size: MB of every function, Lambda assigns CPU in proportion to it
+        :param architecture: of every function, ARM_64 (Graviton) is cheaper per GB-second
+        """
         super().__init__(scope, construct_id, **kwargs)
 
-    sync_toggl_lambda = _lambda.Function(
-        self, 'SyncTogglHandler',
-        runtime=_lambda.Runtime.PYTHON_3_8,
-        code=_lambda.Code.from_asset('lambdas/sync_toggl'),
-        handler='handler.handle',
-    )
-
-    apigw.LambdaRestApi(
-        self, 'Endpoint',
-        handler=sync_toggl_lambda
-    )
\ No newline at end of file
+        # the functions only ship their handler, lambdas/lib and the dependencies come from one shared layer
+        dependencies_layer = _lambda.LayerVersion(
+            self, 'SyncTogglDependencies',
+            code=_lambda.Code.from_asset(
+                'lambdas',
+                exclude=['sync_toggl', '**/__pycache__', '*.pyc'],
+                bundling=BundlingOptions(
+                    image=RUNTIME.bundling_image,
+                    command=['bash', '-c', layer_command(architecture)],
+                ),
+            ),
+            compatible_runtimes=[RUNTIME],
+            compatible_architectures=[architecture],
+            description='lambdas/lib and its third-party dependencies, precompiled',
+        )
+        handler_code = _lambda.Code.from_asset(
+            'lambdas/sync_toggl',
+            exclude=['**/__pycache__', '*.pyc'],
+            bundling=BundlingOptions(
+                image=RUNTIME.bundling_image,
+                command=['bash', '-c', 'cp -r /asset-input/. /asset-output && ' + precompile('/asset-output')],
+            ),
+        )
+        function_options = dict(
+            runtime=RUNTIME,
+            code=handler_code,
+            layers=[dependencies_layer],
+            memory_size=memory_size,
+            architecture=architecture,
+        )
+
+        sync_toggl_lambda = _lambda.Function(
+            self, 'SyncTogglHandler',
+            handler='handler.handle',
+            **function_options,
+        )
+
+        apigw.LambdaRestApi(
+            self, 'Endpoint',
+            handler=sync_toggl_lambda
+        )
+
+        # long backfills are split into per-month jobs, processed by parallel workers
+        dead_letter_queue = sqs.Queue(
+            self, 'SyncJobsDeadLetterQueue',
+            retention_period=Duration.days(14),
+        )
+        jobs_queue = sqs.Queue(
+            self, 'SyncJobsQueue',
+            visibility_timeout=JOBS_VISIBILITY_TIMEOUT,
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=JOBS_MAX_RECEIVE_COUNT, queue=dead_letter_queue),
+        )
+
+        dispatcher_lambda = _lambda.Function(
+            self, 'SyncTogglDispatcher',
+            handler='handler.dispatch',
+            environment={
+                'SYNC_QUEUE_URL': jobs_queue.queue_url,
+            },
+            **function_options,
+        )
+        jobs_queue.grant_send_messages(dispatcher_lambda)
+
+        worker_lambda = _lambda.Function(
+            self, 'SyncTogglWorker',
+            handler='handler.work',
+            timeout=WORKER_TIMEOUT,
+            reserved_concurrent_executions=worker_concurrency,
+            environment=worker_rate_limits(worker_concurrency),
+            **function_options,
+        )
+        # one job per invocation, so a failing month is retried and dead-lettered on its own
+        worker_lambda.add_event_source(event_sources.SqsEventSource(jobs_queue, batch_size=1))
+
+        apigw.LambdaRestApi(
+            self, 'BackfillEndpoint',
+            handler=dispatcher_lambda
+        )
+
+        failures_topic = sns.Topic(self, 'SyncJobFailures')
+        dead_letter_alarm = cloudwatch.Alarm(
+            self, 'SyncJobsDeadLetterAlarm',
+            metric=dead_letter_queue.metric_approximate_number_of_messages_visible(),
+            threshold=1,
+            evaluation_periods=1,
+            comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+        )
+        dead_letter_alarm.add_alarm_action(cw_actions.SnsAction(failures_topic))
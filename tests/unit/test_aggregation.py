@@ -0,0 +1,52 @@
+from datetime import date
+
+from lambdas.lib.aggregation import EntryTable
+
+
+def entry(start, hours, project='ingest', client='Development'):
+    return {
+        'start': start,
+        'duration': int(hours * 3600),
+        'project_name': project,
+        'client_name': client,
+    }
+
+
+ENTRIES = {
+    'bob': [
+        entry('2021-12-31T08:00:00+00:00', 2),
+        entry('2022-01-03T08:00:00+00:00', 1.5, project='support', client='Clients'),
+        entry('2022-01-04T08:00:00+00:00', 4),
+        # running entry
+        entry('2022-01-05T08:00:00+00:00', -1),
+    ],
+    'alice': [
+        entry('2022-01-04T08:00:00+00:00', 8, project='support', client='Clients'),
+    ],
+}
+
+
+def test_totals_by_project_and_week():
+    table = EntryTable(ENTRIES)
+
+    assert len(table) == 4
+    assert table.totals('project') == {'ingest': 6.0, 'support': 9.5}
+    assert table.totals('week') == {'2021-W52': 2.0, '2022-W01': 13.5}
+    assert table.totals(('employee', 'client')) == {
+        ('alice', 'Clients'): 8.0,
+        ('bob', 'Clients'): 1.5,
+        ('bob', 'Development'): 6.0,
+    }
+
+
+def test_monthly_hours_per_employee():
+    table = EntryTable(ENTRIES)
+
+    assert table.monthly_hours() == {
+        'alice': {date(2022, 1, 1): 8.0},
+        'bob': {date(2021, 12, 1): 2.0, date(2022, 1, 1): 5.5},
+    }
+    assert table.monthly_hours(client='Clients') == {
+        'alice': {date(2022, 1, 1): 8.0},
+        'bob': {date(2022, 1, 1): 1.5},
+    }
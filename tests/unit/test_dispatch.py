@@ -0,0 +1,12 @@
+from lambdas.sync_toggl import handler
+
+
+def test_dispatch_rejects_invalid_input():
+    invalid = [
+        {'body': '{"start": "01.03.2022"'},
+        {'body': '["01.03.2022", "31.03.2022"]'},
+        {'queryStringParameters': {'start': '01.03.2022', 'end': '31.03.2022', 'split': 'day'}},
+        {'queryStringParameters': {'start': '2022-03-01', 'end': '31.03.2022'}},
+    ]
+    for event in invalid:
+        assert handler.dispatch(event, None)['statusCode'] == 400
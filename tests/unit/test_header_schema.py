@@ -0,0 +1,25 @@
+import pytest
+
+from lambdas.lib.google_sheets import HeaderSchema
+
+
+def test_columns_and_letters_past_z():
+    schema = HeaderSchema(['Date', 'Daily Hours', ''] + ['Extra %s' % i for i in range(26)] + ['Tasks'])
+    assert schema.column('daily_hours') == 2
+    assert schema.cell('tasks', 7) == 'AD7'
+    assert schema.rows_range(2, 30) == 'A2:AD30'
+    assert schema.skipped == (2,)
+    assert [HeaderSchema.column_letter(col) for col in (1, 26, 27, 52, 703)] == ['A', 'Z', 'AA', 'AZ', 'AAA']
+    with pytest.raises(ValueError):
+        schema.column('missing')
+
+
+def test_records_of_ragged_rows():
+    schema = HeaderSchema(['Date', '', 'Daily Hours', 'Tasks'])
+    assert schema.records([['1 Mar 2022', 'x', '8', 'review'], ['2 Mar 2022'], []]) == [
+        {'date': '1 Mar 2022', 'daily_hours': '8', 'tasks': 'review'},
+        {'date': '2 Mar 2022', 'daily_hours': '', 'tasks': ''},
+        {'date': '', 'daily_hours': '', 'tasks': ''},
+    ]
+    assert HeaderSchema(['Date']).record(['1 Mar 2022', 'ignored']) == {'date': '1 Mar 2022'}
+    assert schema.values({'date': '3 Mar 2022', 'tasks': 'deploy'}) == ['3 Mar 2022', None, None, 'deploy']
@@ -0,0 +1,81 @@
+import json
+
+import requests
+from lambdas.lib.instrumentation import LATENCY_BUCKETS, CallRecord, Instrumentation, Metrics
+from lambdas.lib.ratelimit import TokenBucket
+
+
+def record(latency_ms, endpoint='/time_entries', retries=0, size=100):
+    call = CallRecord('toggl', endpoint, 'GET')
+    call.latency = latency_ms / 1000
+    call.retries = retries
+    call.bytes = size
+    return call
+
+
+def test_percentile_is_bucket_bound_capped_by_max():
+    metrics = Metrics()
+    for latency_ms in [10] * 18 + [300, 700]:
+        metrics(record(latency_ms))
+    stat = metrics.stats[('toggl', 'GET', '/time_entries')]
+    assert stat['buckets'][:LATENCY_BUCKETS.index(1000) + 1] == [18, 0, 0, 1, 1]
+    assert Metrics.percentile(stat, 0.5) == 50
+    assert Metrics.percentile(stat, 0.95) == 500
+    # the slowest call is below its bucket bound
+    assert Metrics.percentile(stat, 1) == 700
+
+
+def test_emf_document_per_endpoint():
+    metrics = Metrics()
+    metrics(record(120, retries=2))
+    metrics(record(80))
+    metrics(record(40, endpoint='/projects/{id}'))
+    documents = [json.loads(line) for line in metrics.to_emf(namespace='Test').splitlines()]
+    assert [document['Endpoint'] for document in documents] == ['GET /time_entries', 'GET /projects/{id}']
+    document = documents[0]
+    assert document['_aws']['CloudWatchMetrics'][0]['Namespace'] == 'Test'
+    assert document['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['Service', 'Endpoint']]
+    names = {metric['Name'] for metric in document['_aws']['CloudWatchMetrics'][0]['Metrics']}
+    assert names <= set(document)
+    assert (document['Calls'], document['Retries'], document['Bytes'], document['LatencyTotal']) == (2, 2, 200, 200)
+
+
+def test_normalize_endpoint():
+    normalize = Instrumentation.normalize_endpoint
+    assert normalize('https://api.track.toggl.com/api/v8/time_entries?start_date=x') == '/api/v8/time_entries'
+    assert normalize('https://api.track.toggl.com/api/v8/workspaces/123/projects') == '/api/v8/workspaces/{id}/projects'
+    assert normalize('https://api.track.toggl.com/api/v8/time_entries/42') == '/api/v8/time_entries/{id}'
+    # ids inside a path segment are kept
+    assert normalize('http://127.0.0.1:8000/reports/v2') == '/reports/v2'
+
+
+def response(status, body):
+    result = requests.Response()
+    result.status_code = status
+    result._content = body
+    result.headers['Content-Length'] = str(len(body))
+    return result
+
+
+def test_responses_are_added_to_the_running_call():
+    instrumentation = Instrumentation()
+    # responses outside of a call are ignored
+    instrumentation.record_response(response(200, b'[]'))
+    assert instrumentation.current() is None
+
+    with instrumentation.call('sheets', 'worksheet.get_all_values', 'READ') as call:
+        assert instrumentation.current() is call
+        instrumentation.record_response(response(429, b'{"error": "quota"}'))
+        instrumentation.record_response(response(200, b'[["date", "hours"]]'))
+    assert (call.status, call.bytes) == (200, 18 + 19)
+    assert instrumentation.current() is None
+
+
+def test_throttling_is_not_latency():
+    instrumentation = Instrumentation()
+    bucket = TokenBucket(rate=20, burst=1)
+    bucket.acquire()
+    with instrumentation.call('toggl', '/time_entries', 'POST') as call:
+        call.throttle(bucket)
+    assert call.throttled > 0.02
+    assert call.latency < call.throttled
@@ -0,0 +1,53 @@
+import threading
+import time
+
+import pytest
+
+from lambdas.lib.pipeline import Pipeline
+
+
+def test_stages_run_concurrently():
+    both_started = threading.Barrier(2, timeout=5)
+
+    def stage(value):
+        # deadlocks (and times out) unless the other stage runs at the same time
+        both_started.wait()
+        return value
+
+    with Pipeline() as stages:
+        stages.submit('sheet', stage, 'rows')
+        stages.submit('toggl', stage, 'entries')
+        assert stages.result('sheet') == 'rows'
+        assert stages.result('toggl') == 'entries'
+        assert stages.run('diff', lambda: 'joined') == 'joined'
+    assert set(stages.timings) == {'sheet', 'toggl', 'diff'}
+
+
+def test_lazy_stages_only_run_when_needed():
+    calls = []
+
+    def fail():
+        calls.append('fail')
+        raise ValueError('stage failed')
+
+    with Pipeline(concurrent=False) as stages:
+        stages.submit('sheet', lambda: calls.append('sheet') or 'rows')
+        stages.submit('toggl', fail)
+        assert stages.result('sheet') == 'rows'
+        assert stages.result('sheet') == 'rows'
+    assert calls == ['sheet']
+    with pytest.raises(ValueError):
+        stages.result('toggl')
+    assert 'total' in stages.format_timings()
+
+
+def test_close_does_not_wait_for_abandoned_stages():
+    release = threading.Event()
+    started = time.perf_counter()
+    with Pipeline(workers=1) as stages:
+        stages.submit('toggl', release.wait, 5)
+        stages.submit('queued', lambda: 'entries')
+    # the running stage is left behind, the queued one is dropped
+    assert time.perf_counter() - started < 1
+    assert stages.stages['queued'].cancelled()
+    release.set()
@@ -0,0 +1,111 @@
+import threading
+from urllib.error import HTTPError
+
+import pytest
+
+from lambdas.lib.toggl_wrapper import SyncPlan, TogglWrapper
+
+
+def toggl_entry(id, date, minutes, description, project='ingest'):
+    return {
+        'id': id, 'pid': 1, 'start': f'{date}T08:00:00+00:00', 'duration': minutes * 60,
+        'description': description, 'project_name': project,
+    }
+
+
+SHEET = [
+    {'duration': 60, 'date': '2022-03-01', 'comment': 'review', 'project': 'ingest'},
+    {'duration': 120, 'date': '2022-03-02', 'comment': 'deploy', 'project': 'ingest'},
+    {'duration': 30, 'date': '2022-03-03', 'comment': 'standup notes', 'project': 'ingest'},
+    {'duration': 45, 'date': '2022-03-04', 'comment': 'planning', 'project': 'ingest'},
+]
+TOGGL = [
+    toggl_entry(1, '2022-03-01', 60, 'review'),
+    toggl_entry(2, '2022-03-02', 90, 'deploy'),
+    toggl_entry(3, '2022-03-03', 30, 'standup'),
+    toggl_entry(4, '2022-03-05', 15, 'forgotten'),
+]
+
+
+class FakeToggl:
+    def __init__(self, fail_id=None, deleted_ids=()):
+        self.calls = []
+        self.lock = threading.Lock()
+        self.fail_id = fail_id
+        self.deleted_ids = deleted_ids
+
+    def record(self, *call):
+        with self.lock:
+            self.calls.append(call)
+
+    def createTimeEntry(self, description, minuteduration, projectid, **kwargs):
+        self.record('create', description)
+        return {'data': toggl_entry(10, '2022-03-04', minuteduration, description)}
+
+    def putTimeEntry(self, parameters):
+        self.record('update', parameters['id'])
+        if parameters['id'] == self.fail_id:
+            raise ConnectionError('connection reset')
+        return {'data': dict(parameters, start='2022-03-01T08:00:00+00:00')}
+
+    def deleteTimeEntry(self, id):
+        self.record('delete', id)
+        if id in self.deleted_ids:
+            raise HTTPError('https://api.track.toggl.com/api/v8/time_entries/%s' % id, 404, 'Not Found', {}, None)
+        return 200
+
+
+def wrapper(toggl):
+    toggl_wrapper = TogglWrapper.__new__(TogglWrapper)
+    toggl_wrapper.toggl = toggl
+    toggl_wrapper.mirror = None
+    toggl_wrapper.projects = {'ingest': 1}
+    return toggl_wrapper
+
+
+def test_near_duplicates_become_updates():
+    plan = SyncPlan.build(SHEET, TOGGL)
+    assert [row['id'] for row in plan.unchanged] == [1]
+    assert [(row['id'], entry['comment']) for row, entry in plan.updates] == [(2, 'deploy'), (3, 'standup notes')]
+    assert plan.creates == [SHEET[3]]
+    assert [row['id'] for row in plan.deletes] == [4]
+    assert 'update  2022-03-02 ingest                 90 ->  120 min' in plan.format()
+
+
+def test_differences_fail_unless_reconciled():
+    toggl = FakeToggl()
+    with pytest.raises(ValueError):
+        wrapper(toggl).sync_to_toggl(SHEET, None, None, toggl_entries=TOGGL)
+    assert wrapper(toggl).sync_to_toggl(SHEET, None, None, toggl_entries=TOGGL, reconcile=True, dry_run=True) is None
+    assert toggl.calls == []
+
+    entry_ids = wrapper(toggl).sync_to_toggl(SHEET, None, None, toggl_entries=TOGGL, reconcile=True)
+    assert sorted(toggl.calls) == [('create', 'planning'), ('delete', 4), ('update', 2), ('update', 3)]
+    assert entry_ids == {
+        ('2022-03-01', 'ingest'): [1], ('2022-03-02', 'ingest'): [2],
+        ('2022-03-03', 'ingest'): [3], ('2022-03-04', 'ingest'): [10],
+    }
+
+
+def test_failed_changes_are_raised_after_the_batch():
+    toggl = FakeToggl(fail_id=2)
+    with pytest.raises(ValueError, match='1 of 4'):
+        wrapper(toggl).sync_to_toggl(SHEET, None, None, toggl_entries=TOGGL, reconcile=True)
+    assert len(toggl.calls) == 4
+
+
+class Mirror:
+    def upsert(self, entries):
+        pass
+
+    def delete(self, entry_ids):
+        self.deleted = list(entry_ids)
+
+
+def test_entries_deleted_already_count_as_deleted():
+    toggl = FakeToggl(deleted_ids=(4,))
+    toggl_wrapper = wrapper(toggl)
+    toggl_wrapper.mirror = Mirror()
+    toggl_wrapper.sync_to_toggl(SHEET, None, None, toggl_entries=TOGGL, reconcile=True)
+    assert ('delete', 4) in toggl.calls
+    assert toggl_wrapper.mirror.deleted == [4]
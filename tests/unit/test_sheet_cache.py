@@ -0,0 +1,77 @@
+import time
+
+from lambdas.lib.sheet_cache import SheetValueCache
+
+
+class Worksheet:
+    def __init__(self):
+        self.rows = [['date', 'daily_hours'], ['1 Mar 2022', '8']]
+        self.reads = 0
+
+    def get_all_values(self):
+        self.reads += 1
+        return [list(row) for row in self.rows]
+
+    def update(self, range_name, values):
+        self.rows[1] = values[0]
+
+    def batch_clear(self, ranges):
+        self.rows[1] = ['1 Mar 2022', '']
+
+
+def test_values_are_served_while_revision_is_unchanged(tmp_path):
+    cache = SheetValueCache(str(tmp_path / 'values.sqlite3'))
+    revision = {'value': '1', 'checks': 0}
+
+    def fetch_revision():
+        revision['checks'] += 1
+        return revision['value']
+
+    worksheet = Worksheet()
+    sheet = cache.wrap(worksheet, 'doc', 'Mar 22', fetch_revision)
+    assert sheet.get_all_values() == worksheet.rows
+    assert sheet.get_all_values() == worksheet.rows
+    assert (worksheet.reads, revision['checks']) == (1, 1)
+
+    # a new run checks the revision once, an unchanged spreadsheet is not read again
+    cache.reset()
+    assert sheet.get_all_values() == worksheet.rows
+    assert (worksheet.reads, revision['checks']) == (1, 2)
+
+    # own writes and changes by others both lead to a new revision
+    sheet.update('A2:B2', [['1 Mar 2022', '6']])
+    revision['value'] = '2'
+    assert sheet.get_all_values()[1] == ['1 Mar 2022', '6']
+    assert (worksheet.reads, revision['checks']) == (2, 3)
+
+
+def test_any_other_call_and_age_revalidate(tmp_path):
+    cache = SheetValueCache(str(tmp_path / 'values.sqlite3'), revision_ttl=0.2)
+    revisions = iter(['1', '2', '3', '3'])
+    checks = []
+
+    def fetch_revision():
+        checks.append(next(revisions))
+        return checks[-1]
+
+    worksheet = Worksheet()
+    sheet = cache.wrap(worksheet, 'doc', 'Mar 22', fetch_revision)
+    sheet.get_all_values()
+    # calls outside of the cached reads may change the sheet
+    sheet.batch_clear(['B2'])
+    assert sheet.get_all_values()[1] == ['1 Mar 2022', '']
+    assert (worksheet.reads, checks) == (2, ['1', '2'])
+
+    # without a new run the revision is checked again once it is outdated
+    time.sleep(0.3)
+    worksheet.rows[1] = ['1 Mar 2022', '7']
+    assert sheet.get_all_values()[1] == ['1 Mar 2022', '7']
+    assert sheet.get_all_values()[1] == ['1 Mar 2022', '7']
+    assert (worksheet.reads, checks) == (3, ['1', '2', '3'])
+
+
+def test_cache_is_opt_in(monkeypatch, tmp_path):
+    monkeypatch.delenv('SHEETS_CACHE_DB', raising=False)
+    assert SheetValueCache.from_env() is None
+    monkeypatch.setenv('SHEETS_CACHE_DB', str(tmp_path / 'values.sqlite3'))
+    assert SheetValueCache.from_env().path == str(tmp_path / 'values.sqlite3')
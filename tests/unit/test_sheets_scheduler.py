@@ -0,0 +1,71 @@
+import threading
+import time
+
+import requests
+from gspread.exceptions import APIError
+
+from lambdas.lib.instrumentation import Instrumentation
+from lambdas.lib.sheets_scheduler import SheetsScheduler
+
+
+def quota_error():
+    response = requests.Response()
+    response.status_code = 429
+    response._content = b'{"error": {"code": 429, "message": "Quota exceeded"}}'
+    response.headers['Retry-After'] = '0'
+    return APIError(response)
+
+
+class Worksheet:
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def get_all_values(self):
+        self.calls.append('get_all_values')
+        self.release.wait(5)
+        return [['date', 'hours'], ['1 Mar 2022', '8']]
+
+    def update(self, range_name, values):
+        self.calls.append('update')
+        if self.calls.count('update') < 3:
+            raise quota_error()
+        return {'updatedRange': range_name}
+
+
+def test_concurrent_identical_reads_are_sent_once():
+    worksheet = Worksheet()
+    sheet = SheetsScheduler(6000, 6000).wrap(worksheet, ('doc', 'Mar 22'))
+    results = []
+    readers = [threading.Thread(target=lambda: results.append(sheet.get_all_values())) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    # the first read is held until the others had time to join it
+    time.sleep(0.2)
+    worksheet.release.set()
+    for reader in readers:
+        reader.join()
+    assert worksheet.calls == ['get_all_values']
+    assert len(results) == 4 and all(rows == results[0] for rows in results)
+    # the callers got their own rows
+    assert len({id(rows[1]) for rows in results}) == 4
+
+
+def test_quota_errors_are_retried():
+    worksheet = Worksheet()
+    sheet = SheetsScheduler(6000, 6000).wrap(worksheet, ('doc', 'Mar 22'), write_methods=('update',))
+    assert sheet.update('A1:B1', [['a', 'b']]) == {'updatedRange': 'A1:B1'}
+    assert worksheet.calls == ['update'] * 3
+
+
+def test_retries_are_recorded_as_one_call(monkeypatch):
+    instrumentation = Instrumentation()
+    monkeypatch.setattr('lambdas.lib.sheets_scheduler.instrumentation', instrumentation)
+    records = []
+    instrumentation.add_hook(records.append)
+    worksheet = Worksheet()
+    sheet = SheetsScheduler(6000, 6000).wrap(worksheet, ('doc', 'Mar 22'), write_methods=('update',))
+    sheet.update('A1:B1', [['a', 'b']])
+    assert [(r.service, r.endpoint, r.method, r.retries, r.error) for r in records] == [
+        ('sheets', 'worksheet.update', 'WRITE', 2, None)
+    ]
@@ -0,0 +1,34 @@
+from datetime import datetime
+
+from lambdas.lib.sync_state import MemorySyncStateBackend, SqliteSyncStateBackend, SyncStateLedger
+
+
+ROWS = [
+    {'duration': 60, 'date': '2022-03-01', 'comment': 'review', 'project': 'ingest'},
+    {'duration': 90, 'date': '2022-03-02', 'comment': 'deploy', 'project': 'ingest'},
+]
+START = datetime(2022, 3, 1)
+END = datetime(2022, 3, 3)
+
+
+def test_unchanged_days_are_skipped():
+    ledger = SyncStateLedger('sheet', backend=MemorySyncStateBackend())
+    changed = ledger.changed_dates(ROWS, START, END)
+    assert changed == ['2022-03-01', '2022-03-02', '2022-03-03']
+
+    ledger.record(ROWS, changed, {('2022-03-01', 'ingest'): [11], ('2022-03-02', 'ingest'): [12]})
+    assert ledger.changed_dates(ROWS, START, END) == []
+
+    edited = [ROWS[0], dict(ROWS[1], duration=120)]
+    assert ledger.changed_dates(edited, START, END) == ['2022-03-02']
+
+
+def test_sqlite_backend_roundtrip(tmp_path):
+    backend = SqliteSyncStateBackend(str(tmp_path / 'state.sqlite3'))
+    ledger = SyncStateLedger('sheet', backend=backend)
+    ledger.record(ROWS, ['2022-03-01'], {('2022-03-01', 'ingest'): [11]})
+
+    stored = backend.load('sheet', ['2022-03-01', '2022-03-02'])
+    assert list(stored) == ['2022-03-01']
+    assert stored['2022-03-01']['ingest']['entry_ids'] == [11]
+    assert backend.load('other-sheet', ['2022-03-01']) == {}
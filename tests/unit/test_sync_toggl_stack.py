@@ -1,21 +1,150 @@
+import subprocess
+import sys
+
 import aws_cdk as core
 import aws_cdk.assertions as assertions
-from sync_toggl.sync_toggl_stack import SyncTogglStack
+from aws_cdk import BundlingOptions, aws_lambda as _lambda
+from sync_toggl import sync_toggl_stack
+from sync_toggl.sync_toggl_stack import SyncTogglStack, layer_command, precompile
+
+
+# skip the Docker builds of the layer and the handler code, the template is the same
+NO_BUNDLING = {"aws:cdk:bundling-stacks": []}
 
 
 def test_sqs_queue_created():
-    app = core.App()
+    app = core.App(context=NO_BUNDLING)
     stack = SyncTogglStack(app, "sync-toggl")
     template = assertions.Template.from_stack(stack)
 
+    # throttled worker invocations return their job to the queue, six worker timeouts leave room for them
     template.has_resource_properties("AWS::SQS::Queue", {
-        "VisibilityTimeout": 300
+        "VisibilityTimeout": 6 * 300
     })
 
 
 def test_sns_topic_created():
-    app = core.App()
+    app = core.App(context=NO_BUNDLING)
     stack = SyncTogglStack(app, "sync-toggl")
     template = assertions.Template.from_stack(stack)
 
     template.resource_count_is("AWS::SNS::Topic", 1)
+
+
+def test_failed_jobs_go_to_dead_letter_queue():
+    app = core.App(context=NO_BUNDLING)
+    stack = SyncTogglStack(app, "sync-toggl")
+    template = assertions.Template.from_stack(stack)
+
+    template.resource_count_is("AWS::SQS::Queue", 2)
+    template.has_resource_properties("AWS::SQS::Queue", {
+        "RedrivePolicy": assertions.Match.object_like({"maxReceiveCount": 5})
+    })
+    template.has_resource_properties("AWS::CloudWatch::Alarm", {
+        "Threshold": 1,
+        "AlarmActions": assertions.Match.any_value(),
+    })
+
+
+def test_dispatcher_sends_jobs_to_queue():
+    app = core.App(context=NO_BUNDLING)
+    stack = SyncTogglStack(app, "sync-toggl")
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "handler.dispatch",
+        "Environment": {
+            "Variables": {"SYNC_QUEUE_URL": assertions.Match.any_value()}
+        },
+    })
+    template.has_resource_properties("AWS::IAM::Policy", {
+        "PolicyDocument": {
+            "Statement": assertions.Match.array_with([
+                assertions.Match.object_like({
+                    "Action": assertions.Match.array_with(["sqs:SendMessage"])
+                })
+            ])
+        }
+    })
+
+
+def test_workers_consume_queue_with_capped_concurrency():
+    app = core.App(context=NO_BUNDLING)
+    stack = SyncTogglStack(app, "sync-toggl", worker_concurrency=3)
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "handler.work",
+        "Timeout": 300,
+        "ReservedConcurrentExecutions": 3,
+        # the three workers share the rate limits of one Toggl token and Google account
+        "Environment": {
+            "Variables": {
+                "TOGGL_RATE_LIMIT": str(1 / 3),
+                "TOGGL_RATE_BURST": "1",
+                "SHEETS_READS_PER_MINUTE": "20",
+                "SHEETS_WRITES_PER_MINUTE": "20",
+                "SHEETS_BURST": "1",
+            }
+        },
+    })
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {
+        "BatchSize": 1
+    })
+
+
+def test_functions_share_precompiled_dependency_layer():
+    app = core.App(context=NO_BUNDLING)
+    stack = SyncTogglStack(app, "sync-toggl")
+    template = assertions.Template.from_stack(stack)
+
+    template.resource_count_is("AWS::Lambda::LayerVersion", 1)
+    template.has_resource_properties("AWS::Lambda::LayerVersion", {
+        "CompatibleRuntimes": ["python3.12"],
+    })
+    functions = template.find_resources("AWS::Lambda::Function")
+    assert len(functions) == 3
+    for function in functions.values():
+        assert function["Properties"]["Runtime"] == "python3.12"
+        assert len(function["Properties"]["Layers"]) == 1
+
+    command = layer_command(_lambda.Architecture.ARM_64)
+    assert "-r requirements.txt" in command and "manylinux2014_aarch64" in command
+    assert "--python-version 3.12" in command
+    assert "cp -r /asset-input/lib" in command and "compileall" in command
+
+
+def test_memory_and_architecture_are_configurable():
+    app = core.App(context=NO_BUNDLING)
+    stack = SyncTogglStack(app, "sync-toggl", memory_size=512, architecture=_lambda.Architecture.X86_64)
+    template = assertions.Template.from_stack(stack)
+
+    for function in template.find_resources("AWS::Lambda::Function").values():
+        assert function["Properties"]["MemorySize"] == 512
+        assert function["Properties"]["Architectures"] == ["x86_64"]
+    template.has_resource_properties("AWS::Lambda::LayerVersion", {
+        "CompatibleArchitectures": ["x86_64"],
+    })
+
+
+def test_bundles_are_precompiled_without_source_checks(monkeypatch, tmp_path):
+    commands = []
+
+    def bundling_options(**kwargs):
+        commands.append(kwargs['command'][-1])
+        return BundlingOptions(**kwargs)
+
+    monkeypatch.setattr(sync_toggl_stack, 'BundlingOptions', bundling_options)
+    app = core.App(context=NO_BUNDLING)
+    assertions.Template.from_stack(SyncTogglStack(app, "sync-toggl"))
+    # the layer and the handler code
+    assert len(commands) == 2
+    assert all('compileall -q -j 0 --invalidation-mode unchecked-hash' in command for command in commands)
+
+    # the .pyc stays valid when the zip resets the modification time of the source
+    source = tmp_path / 'module.py'
+    source.write_text('VALUE = 1\n')
+    subprocess.run(precompile(str(tmp_path)).replace('python', sys.executable, 1), shell=True, check=True)
+    pyc = next((tmp_path / '__pycache__').glob('module.*.pyc')).read_bytes()
+    # flags of PEP 552: hash based, source not checked
+    assert int.from_bytes(pyc[4:8], 'little') == 0b01
@@ -0,0 +1,46 @@
+import threading
+from datetime import datetime
+
+from lambdas.lib.toggl.TogglPy import Toggl
+from lambdas.sync_toggl import handler
+
+
+EMPLOYEES = [
+    {'nickname': 'anna', 'timesheet_id': 'sheet-anna', 'toggl_token_env': 'TOGGL_TOKEN_ANNA'},
+    {'nickname': 'ben', 'timesheet_id': 'sheet-ben', 'toggl_token_env': 'TOGGL_TOKEN_BEN'},
+    {'nickname': 'carl', 'timesheet_id': 'sheet-carl', 'toggl_token_env': 'TOGGL_TOKEN_MISSING'},
+    {'nickname': 'dora'},
+]
+
+
+def test_api_keys_do_not_leak_between_instances():
+    first, second = Toggl(), Toggl()
+    first.setAPIKey('first')
+    second.setAPIKey('second')
+    assert first.headers['Authorization'] != second.headers['Authorization']
+    assert Toggl.headers['Authorization'] == ''
+
+
+def test_team_sync_isolates_failures(monkeypatch):
+    monkeypatch.setattr(handler, 'load_employees', lambda: EMPLOYEES)
+    monkeypatch.setenv('TOGGL_TOKEN_ANNA', 'token-anna')
+    monkeypatch.setenv('TOGGL_TOKEN_BEN', 'token-ben')
+    monkeypatch.delenv('TOGGL_TOKEN_MISSING', raising=False)
+    calls = {}
+    lock = threading.Lock()
+
+    def sync_changed_days(start, end, full=False, spreadsheet=None, api_key=None, reconcile=False, dry_run=False):
+        with lock:
+            calls[spreadsheet] = api_key
+        if spreadsheet == 'sheet-ben':
+            raise ValueError("Toggl has data missing in google sheets")
+        return 3
+
+    monkeypatch.setattr(handler, 'sync_changed_days', sync_changed_days)
+    report = handler.sync_team(datetime(2022, 3, 1), datetime(2022, 3, 31), workers=2)
+
+    assert calls == {'sheet-anna': 'token-anna', 'sheet-ben': 'token-ben'}
+    assert [(row['employee'], row['status'], row['days']) for row in report] == [
+        ('anna', 'ok', 3), ('ben', 'failed', 0), ('carl', 'failed', 0), ('dora', 'skipped', 0),
+    ]
+    assert 'TOGGL_TOKEN_MISSING' in report[2]['error']
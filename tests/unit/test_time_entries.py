@@ -0,0 +1,48 @@
+import threading
+from datetime import datetime, timedelta, timezone
+
+from lambdas.lib.toggl import TogglPy
+from lambdas.lib.toggl.TogglPy import Toggl
+
+
+START = datetime(2022, 3, 1, tzinfo=timezone.utc)
+# an entry every hour for three days, the first one starts exactly at START
+ENTRIES = [
+    {'id': i + 1, 'start': (START + timedelta(hours=i)).isoformat(), 'duration': 1800}
+    for i in range(72)
+]
+
+
+class WindowedToggl(Toggl):
+    """Answers the listing like the v8 API: both ends included, unordered, cut at the limit"""
+
+    def __init__(self):
+        self.windows = []
+        self.lock = threading.Lock()
+
+    def getTimeEntries(self, start_date, end_date):
+        with self.lock:
+            self.windows.append((start_date, end_date))
+        entries = [e for e in ENTRIES if start_date <= self.parseTime(e['start']) <= end_date]
+        return list(reversed(entries))[:TogglPy.TIME_ENTRIES_LIMIT]
+
+
+def test_windows_at_the_limit_are_halved(monkeypatch):
+    monkeypatch.setattr(TogglPy, 'TIME_ENTRIES_LIMIT', 10)
+    toggl = WindowedToggl()
+    entries = list(toggl.iterTimeEntries(START, START + timedelta(days=3), window=timedelta(days=1)))
+
+    # 25 entries of a day (both ends included) are split down to windows of six hours
+    assert len(toggl.windows) == 3 + 6 + 12
+    assert (START, START + timedelta(hours=6)) in toggl.windows
+    assert [e['id'] for e in entries] == [e['id'] for e in ENTRIES]
+
+
+def test_entries_on_window_boundaries_are_yielded_once_in_start_order():
+    toggl = WindowedToggl()
+    entries = list(toggl.iterTimeEntries(START, START + timedelta(days=3), window=timedelta(hours=5), workers=3))
+
+    ids = [e['id'] for e in entries]
+    assert len(ids) == len(set(ids)) == len(ENTRIES)
+    starts = [toggl.parseTime(e['start']) for e in entries]
+    assert starts == sorted(starts)
@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta, timezone
+
+from lambdas.lib.toggl_mirror import TimeEntryMirror
+
+
+MARCH = datetime(2022, 3, 1, tzinfo=timezone.utc)
+APRIL = datetime(2022, 4, 1, tzinfo=timezone.utc)
+
+
+def entry(id, day, description='review', at='2022-03-20T10:00:00+00:00', **fields):
+    return dict({
+        'id': id, 'pid': 7, 'start': f'2022-03-{day:02d}T09:00:00+00:00', 'duration': 3600,
+        'description': description, 'at': at,
+    }, **fields)
+
+
+class StubToggl:
+    headers = {'Authorization': 'Basic stub'}
+
+    def __init__(self, entries, deltas):
+        self.entries = entries
+        self.deltas = list(deltas)
+        self.downloads = []
+        self.since = []
+
+    def iterTimeEntries(self, start, end):
+        self.downloads.append((start, end))
+        return iter(self.entries)
+
+    def getTimeEntriesSince(self, since):
+        self.since.append(since)
+        return self.deltas.pop(0)
+
+
+def descriptions(mirror):
+    return [(e['id'], e['description']) for e in mirror.entries(MARCH, APRIL)]
+
+
+def test_month_range_excludes_its_end():
+    assert [key for key, _, _ in TimeEntryMirror.months(MARCH, APRIL)] == ['2022-03']
+    assert [key for key, _, _ in TimeEntryMirror.months(MARCH, APRIL.replace(day=2))] == ['2022-03', '2022-04']
+
+
+def test_deltas_apply_changes_and_tombstones(tmp_path):
+    changed_at = datetime(2022, 3, 21, tzinfo=timezone.utc).timestamp()
+    toggl = StubToggl(
+        [entry(1, 1), entry(2, 2), entry(3, 3, at='2022-03-20T12:00:00+00:00')],
+        [
+            (changed_at, [
+                entry(2, 2, 'deploy', at='2022-03-21T00:00:00+00:00'),
+                entry(3, 3, server_deleted_at='2022-03-21T00:00:00+00:00'),
+                entry(4, 4, 'planning', at='2022-03-21T00:00:00+00:00'),
+            ]),
+            (changed_at + 60, []),
+        ],
+    )
+    mirror = TimeEntryMirror(toggl, str(tmp_path / 'mirror.sqlite3'), max_age=3600)
+
+    mirror.refresh(MARCH, APRIL)
+    assert toggl.downloads == [(MARCH, APRIL)]
+    assert toggl.since == []
+    assert descriptions(mirror) == [(1, 'review'), (2, 'review'), (3, 'review')]
+
+    # the month is fresh, only the changes since the latest `at` of the download are asked for
+    mirror.refresh(MARCH, APRIL)
+    assert len(toggl.downloads) == 1
+    assert toggl.since == [datetime(2022, 3, 20, 12, tzinfo=timezone.utc).timestamp()]
+    assert descriptions(mirror) == [(1, 'review'), (2, 'deploy'), (4, 'planning')]
+
+    # own writes do not move the watermark, the next delta starts at the server time of the last one
+    mirror.upsert([entry(5, 5, 'standup', at='2022-03-25T00:00:00+00:00')])
+    mirror.refresh(MARCH, APRIL)
+    assert toggl.since[-1] == changed_at
+    assert descriptions(mirror)[-1] == (5, 'standup')
+
+
+def test_stale_months_are_downloaded_again(tmp_path):
+    toggl = StubToggl([entry(1, 1)], [])
+    mirror = TimeEntryMirror(toggl, str(tmp_path / 'mirror.sqlite3'), max_age=0)
+    mirror.refresh(MARCH, APRIL)
+    toggl.entries = [entry(1, 1, 'edited long ago')]
+    mirror.refresh(MARCH, APRIL)
+    assert len(toggl.downloads) == 2 and toggl.since == []
+    assert descriptions(mirror) == [(1, 'edited long ago')]
+
+
+def test_exact_refresh_downloads_months_the_delta_does_not_cover(tmp_path):
+    toggl = StubToggl([entry(1, 1)], [(0, [])] * 2)
+    mirror = TimeEntryMirror(toggl, str(tmp_path / 'mirror.sqlite3'), max_age=3600)
+    mirror.refresh(MARCH, APRIL)
+    # an entry added by hand weeks later is not part of the delta
+    toggl.entries = [entry(1, 1), entry(2, 2, 'added later')]
+    mirror.refresh(MARCH, APRIL)
+    assert descriptions(mirror) == [(1, 'review')]
+
+    mirror.refresh(MARCH, APRIL, exact=True)
+    assert toggl.downloads == [(MARCH, APRIL)] * 2
+    assert descriptions(mirror) == [(1, 'review'), (2, 'added later')]
+
+    # the last days are covered by the delta
+    recent = datetime.now(timezone.utc) - timedelta(days=2)
+    mirror.refresh(recent, recent + timedelta(days=1))
+    mirror.refresh(recent, recent + timedelta(days=1), exact=True)
+    assert len(toggl.downloads) == 2 + len(TimeEntryMirror.months(recent, recent + timedelta(days=1)))
@@ -0,0 +1,88 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+
+import pytest
+
+from lambdas.lib.toggl.retry import RetryPolicy
+from lambdas.lib.toggl.TogglPy import Endpoints, Toggl
+
+
+class LostResponseHandler(BaseHTTPRequestHandler):
+    """Stores every created entry, but answers the first POST with a 502"""
+    entries = []
+    posts = 0
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply(200, self.entries)
+
+    def do_POST(self):
+        entry = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['time_entry']
+        entry['id'] = len(self.entries) + 1
+        entry['start'] = entry['start'].replace('.000Z', '+00:00')
+        self.entries.append(entry)
+        LostResponseHandler.posts += 1
+        if LostResponseHandler.posts == 1:
+            self.reply(502, {})
+        else:
+            self.reply(200, {'data': entry})
+
+
+@pytest.fixture
+def toggl_server(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), LostResponseHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(Endpoints, 'TIME_ENTRIES', 'http://127.0.0.1:%s/time_entries' % server.server_port)
+    yield server
+    server.shutdown()
+
+
+def test_classification():
+    policy = RetryPolicy()
+    assert policy.is_retryable(HTTPError('url', 503, 'unavailable', None, None))
+    assert not policy.is_retryable(HTTPError('url', 400, 'bad request', None, None))
+    assert policy.is_retryable(URLError(TimeoutError()))
+    # a POST that may have reached the server is not resent
+    assert not policy.is_retryable(URLError(TimeoutError()), idempotent=False)
+    assert policy.is_retryable(URLError(ConnectionRefusedError()), idempotent=False)
+
+
+def test_create_is_not_duplicated_when_response_is_lost(toggl_server):
+    toggl = Toggl()
+    toggl.setRetryPolicy(RetryPolicy(base_delay=0.01))
+    result = toggl.createTimeEntry(minuteduration=30, description='review', projectid=7,
+                                   year=2022, month=3, day=1, hour=10)
+
+    assert result['data']['id'] == 1
+    assert len(LostResponseHandler.entries) == 1
+
+
+def test_failed_recovery_counts_as_failed_attempt():
+    calls = []
+
+    def create():
+        calls.append('create')
+        if len(calls) == 1:
+            raise HTTPError('url', 503, 'unavailable', None, None)
+        return {'data': {'id': 1}}
+
+    def recover():
+        calls.append('recover')
+        if calls.count('recover') == 1:
+            raise URLError(TimeoutError())
+
+    result = RetryPolicy(base_delay=0.01).call(create, idempotent=False, before_retry=recover)
+    assert result == {'data': {'id': 1}}
+    assert calls == ['create', 'recover', 'recover', 'create']
@@ -0,0 +1,109 @@
+import gzip
+import io
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from lambdas.lib.instrumentation import instrumentation
+from lambdas.lib.toggl.TogglPy import Endpoints, Toggl, decompress
+
+
+CSV = '\ufeffUser,Project,Description,Duration\n' + ''.join(
+    'Anna,ingest,Task %s,01:00:00\n' % i for i in range(2000)
+)
+
+
+class ReportHandler(BaseHTTPRequestHandler):
+    """Serves the detailed report csv, encoded by the encode(body) -> (body, Content-Encoding) of the test"""
+    encode = staticmethod(lambda body: (body, None))
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body, encoding = self.encode(CSV.encode('utf-8'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def report_server(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ReportHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(Endpoints, 'REPORT_DETAILED', 'http://127.0.0.1:%s/reports/api/v2/details' % server.server_port)
+    yield server
+    server.shutdown()
+    ReportHandler.encode = staticmethod(lambda body: (body, None))
+
+
+@pytest.fixture
+def records():
+    records = []
+    instrumentation.add_hook(records.append)
+    yield records
+    instrumentation.remove_hook(records.append)
+
+
+def toggl():
+    toggl = Toggl()
+    toggl.setRetryPolicy(None)
+    toggl.chunk_size = 1024
+    return toggl
+
+
+def test_stream_raw_copies_in_chunks(report_server, records):
+    target = io.BytesIO()
+    written = toggl().streamRaw(Endpoints.REPORT_DETAILED + '.csv', {'workspace_id': 1}, target)
+    assert written == len(CSV.encode('utf-8'))
+    assert target.getvalue().decode('utf-8') == CSV
+    assert [(r.endpoint, r.status, r.bytes) for r in records] == [('/reports/api/v2/details.csv', 200, written)]
+
+
+def test_report_rows_are_parsed_while_streaming(report_server, records):
+    rows = toggl().iterDetailedReportCSV({'workspace_id': 1})
+    first = next(rows)
+    assert first == {'User': 'Anna', 'Project': 'ingest', 'Description': 'Task 0', 'Duration': '01:00:00'}
+    # the call is recorded once the body is read
+    assert records == []
+    assert sum(1 for _ in rows) == 1999
+    assert [(r.status, r.bytes, r.error) for r in records] == [(200, len(CSV.encode('utf-8')), None)]
+
+
+def raw_deflate(body):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+ENCODINGS = {
+    'gzip': lambda body: (gzip.compress(body), 'gzip'),
+    'deflate': lambda body: (zlib.compress(body), 'deflate'),
+    # some servers send deflate without the zlib header
+    'raw deflate': lambda body: (raw_deflate(body), 'deflate'),
+}
+
+
+@pytest.mark.parametrize('encoding', list(ENCODINGS))
+def test_compressed_report_is_decoded_in_chunks(report_server, records, encoding):
+    ReportHandler.encode = staticmethod(ENCODINGS[encoding])
+    compressed, _ = ENCODINGS[encoding](CSV.encode('utf-8'))
+    # the body spans many chunks of the reader
+    assert len(compressed) > 4 * toggl().chunk_size
+    rows = list(toggl().iterDetailedReportCSV({'workspace_id': 1}))
+    assert len(rows) == 2000 and rows[-1]['Description'] == 'Task 1999'
+    # bytes on the wire, before decompression
+    assert records[0].bytes == len(compressed)
+
+
+@pytest.mark.parametrize('encoding', list(ENCODINGS))
+def test_full_bodies_are_decompressed(encoding):
+    body = b'[{"id": 1, "description": "review"}]'
+    compressed, content_encoding = ENCODINGS[encoding](body)
+    assert decompress(compressed, content_encoding) == body
+    assert decompress(body, None) == body
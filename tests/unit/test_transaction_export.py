@@ -0,0 +1,127 @@
+import pytest
+
+from lambdas.lib.google_sheets import GoogleTransactionSheets, HeaderSchema
+
+
+class Transaction:
+    def __init__(self, i):
+        self.id = i
+        self.meta = {'id': i, 'amount': -i}
+
+
+class FakeWorksheet:
+    def __init__(self, fail_at=None):
+        self.updates = []
+        self.fail_at = fail_at
+
+    def update(self, range_name, values):
+        if len(self.updates) == self.fail_at:
+            raise ConnectionError('connection reset')
+        self.updates.append((range_name, values))
+
+    def get_all_values(self):
+        return self.values
+
+    def batch_update(self, cells, value_input_option=None):
+        self.updates.extend((cell['range'], cell['values']) for cell in cells)
+
+    def format(self, range_name, cell_format):
+        self.updates.append((range_name, cell_format))
+
+
+def transaction_sheet(worksheet, headers):
+    sheets = GoogleTransactionSheets.__new__(GoogleTransactionSheets)
+    sheets.doc_name, sheets.sheet_name = 'doc', 'Transactions'
+    sheets.sheet = worksheet
+    sheets.schema = HeaderSchema(headers)
+    sheets.headers = sheets.schema.headers
+    sheets.first_data_row = 2
+    sheets.last_data_row = None
+    return sheets
+
+
+def test_chunks_use_a1_columns_past_z(monkeypatch, tmp_path):
+    monkeypatch.setenv('SHEETS_CHECKPOINT_DIR', str(tmp_path))
+    headers = ['id', 'amount'] + ['column_%s' % i for i in range(28)]
+    sheets = transaction_sheet(FakeWorksheet(), headers)
+    written = sheets.write_transactions((Transaction(i) for i in range(5)), chunk_size=2)
+    assert written == 5
+    assert [r for r, _ in sheets.sheet.updates] == ['A2:AD3', 'A4:AD5', 'A6:AD6']
+    assert sheets.sheet.updates[0][1][1][:3] == [1, -1, None]
+    assert not list(tmp_path.iterdir())
+
+
+def test_interrupted_export_resumes(monkeypatch, tmp_path):
+    monkeypatch.setenv('SHEETS_CHECKPOINT_DIR', str(tmp_path))
+    failing = transaction_sheet(FakeWorksheet(fail_at=1), ['id', 'amount'])
+    with pytest.raises(ConnectionError):
+        failing.write_transactions([Transaction(i) for i in range(5)], chunk_size=2)
+    assert [r for r, _ in failing.sheet.updates] == ['A2:B3']
+
+    resumed = transaction_sheet(FakeWorksheet(), ['id', 'amount'])
+    assert resumed.write_transactions([Transaction(i) for i in range(5)], chunk_size=2) == 5
+    assert [r for r, _ in resumed.sheet.updates] == ['A4:B5', 'A6:B6']
+
+    # other transactions than the checkpoint expects are written from the start
+    failing.sheet.fail_at = 2
+    with pytest.raises(ConnectionError):
+        failing.write_transactions([Transaction(i) for i in range(5)], chunk_size=2)
+    restarted = transaction_sheet(FakeWorksheet(), ['id', 'amount'])
+    restarted.write_transactions([Transaction(i) for i in range(10, 15)], chunk_size=2)
+    assert [r for r, _ in restarted.sheet.updates] == ['A2:B3', 'A4:B5', 'A6:B6']
+
+
+def test_mismatching_iterator_is_not_buffered(monkeypatch, tmp_path):
+    monkeypatch.setenv('SHEETS_CHECKPOINT_DIR', str(tmp_path))
+    failing = transaction_sheet(FakeWorksheet(fail_at=1), ['id', 'amount'])
+    with pytest.raises(ConnectionError):
+        failing.write_transactions((Transaction(i) for i in range(5)), chunk_size=2)
+
+    # the skipped transactions are only hashed, a consumed generator cannot start over
+    restarted = transaction_sheet(FakeWorksheet(), ['id', 'amount'])
+    with pytest.raises(ValueError):
+        restarted.write_transactions((Transaction(i) for i in range(10, 15)), chunk_size=2)
+    assert restarted.write_transactions((Transaction(i) for i in range(10, 15)), chunk_size=2) == 5
+    assert [r for r, _ in restarted.sheet.updates] == ['A2:B3', 'A4:B5', 'A6:B6']
+
+
+class Unnumbered(Transaction):
+    def __init__(self, i):
+        super().__init__(i)
+        del self.meta['id']
+
+
+def test_transactions_without_ids_resume_only_their_own_checkpoint(monkeypatch, tmp_path):
+    monkeypatch.setenv('SHEETS_CHECKPOINT_DIR', str(tmp_path))
+    failing = transaction_sheet(FakeWorksheet(fail_at=1), ['id', 'amount'])
+    with pytest.raises(ConnectionError):
+        failing.write_transactions([Unnumbered(i) for i in range(4)], chunk_size=2)
+
+    # a leftover checkpoint does not skip the first rows of another export
+    other = transaction_sheet(FakeWorksheet(), ['id', 'amount'])
+    other.write_transactions([Unnumbered(i) for i in range(10, 14)], chunk_size=2)
+    assert [r for r, _ in other.sheet.updates] == ['A2:B3', 'A4:B5']
+
+    failing.sheet = FakeWorksheet(fail_at=1)
+    with pytest.raises(ConnectionError):
+        failing.write_transactions([Unnumbered(i) for i in range(4)], chunk_size=2)
+    resumed = transaction_sheet(FakeWorksheet(), ['id', 'amount'])
+    resumed.write_transactions([Unnumbered(i) for i in range(4)], chunk_size=2)
+    assert [r for r, _ in resumed.sheet.updates] == ['A4:B5']
+
+
+def test_sync_reads_records_by_schema_slug():
+    worksheet = FakeWorksheet()
+    # rows come back without their trailing empty cells
+    worksheet.values = [['id', 'Status', 'Link', 'Supplier', 'Amount'], ['0', 'pending'], ['1', 'booked', 'x', 'Shop']]
+    sheets = transaction_sheet(worksheet, worksheet.values[0])
+    transactions = [Transaction(0), Transaction(1)]
+    for tr in transactions:
+        tr.meta.update(message='', status='booked', link='x', supplier='Shop')
+    sheets.sync_transactions(transactions)
+    assert worksheet.updates == [('B2', [['booked']]), ('C2', [['x']]), ('D2', [['Shop']])]
+    assert [tr.meta['status'] for tr in transactions] == ['pending', 'booked']
+
+    sheets.highlight(1)
+    sheets.unhighlight(1)
+    assert [r for r, _ in worksheet.updates[3:]] == ['A3:E3', 'A3:E3']